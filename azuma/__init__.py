@@ -8,14 +8,37 @@
 # the Free Software Foundation; either version 3 of the License, or
 # (at your option) any later version.
 
-from .audio import convert
-from .file import AudioFile
-from .lyric import Lyric
-from .store import Store
-from .music import Music
-from .repository import Repository, generate_repository_from_store
-from .uuid import UUID16
+import importlib
 
 __version__ = '1.0'
 
-__all__ = ['convert', 'AudioFile', 'Lyric', 'Store', 'Music', 'Repository', 'generate_repository_from_store', 'UUID16', 'exception']
+# 子模块在第一次访问时才导入，`azuma version`等命令不会载入SQLAlchemy、pydub与mutagen
+_LAZY_ATTRIBUTES = {
+    'convert': 'audio',
+    'convert_many': 'audio',
+    'TranscodeCache': 'cache',
+    'AudioFile': 'file',
+    'Lyric': 'lyric',
+    'Store': 'store',
+    'Music': 'music',
+    'Repository': 'repository',
+    'generate_repository_from_store': 'repository',
+    'UUID16': 'uuid',
+}
+
+
+def __getattr__(name):
+    if name == 'exception':
+        return importlib.import_module('.exception', __name__)
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module('.' + _LAZY_ATTRIBUTES[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+
+__all__ = ['convert', 'convert_many', 'TranscodeCache', 'AudioFile', 'Lyric', 'Store', 'Music', 'Repository', 'generate_repository_from_store', 'UUID16', 'exception']
@@ -8,29 +8,59 @@
 # the Free Software Foundation; either version 3 of the License, or
 # (at your option) any later version.
 
-from pydub import AudioSegment
 from azuma.file import AudioFile
 from azuma.exception import InvalidQualityException
+from azuma.profiling import span
 import os
 
 
-def convert(input_file: AudioFile, output_path: str, quality: int):
+def get_bitrate(quality: int):
     """
-    转换文件质量并清除歌曲信息，返回生成文件的AudioFile
+    获取目标音质对应的编码码率，None表示不限制码率
     """
-    curr = AudioSegment.from_file(input_file.path)
-    format = os.path.splitext(output_path)[-1][1:]
     if quality == AudioFile.NORMAL:
-        bitrate = '128k'
+        return '128k'
     elif quality == AudioFile.BETTER:
-        bitrate = '192k'
+        return '192k'
     elif quality == AudioFile.HIGH:
-        bitrate = '320k'
+        return '320k'
     elif quality == AudioFile.BEST:
-        bitrate = None
+        return None
     elif quality == AudioFile.ORIGINAL:
-        bitrate = None
+        return None
     else:
         raise InvalidQualityException(quality)
-    curr.export(output_path, format=format, bitrate=bitrate)
-    return AudioFile(output_path)
+
+
+def get_encoder_settings(quality: int, format: str) -> str:
+    """
+    获取转码参数的描述，用于区分转码缓存
+    """
+    return f'pydub:{format}:{get_bitrate(quality)}'
+
+
+def convert_many(input_file: AudioFile, outputs: dict[int, str]) -> dict[int, AudioFile]:
+    """
+    将同一文件转换为多个音质并清除歌曲信息，源文件只解码一次。
+    outputs为{音质: 输出路径}，返回{音质: 生成文件的AudioFile}
+    """
+    bitrates = {quality: get_bitrate(quality) for quality in outputs}  # Check all qualities before decoding
+    if not outputs:
+        return {}
+    from pydub import AudioSegment  # pydub is slow to import and only needed when transcoding
+    with span('decode', file=input_file.path):
+        curr = AudioSegment.from_file(input_file.path)
+    result = {}
+    for quality, output_path in outputs.items():
+        format = os.path.splitext(output_path)[-1][1:]
+        with span('encode', tier=AudioFile.get_quality_str(quality), format=format):
+            curr.export(output_path, format=format, bitrate=bitrates[quality])
+        result[quality] = AudioFile(output_path)
+    return result
+
+
+def convert(input_file: AudioFile, output_path: str, quality: int):
+    """
+    转换文件质量并清除歌曲信息，返回生成文件的AudioFile
+    """
+    return convert_many(input_file, {quality: output_path})[quality]
@@ -0,0 +1,103 @@
+# Azuma Python Module https://azuma.sorasky.in/
+# Copyright (C) 2022  Sora
+# ALL RIGHTS RESERVED.
+#
+# The module is a part of Azuma Repository Manager Module.
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+import os
+import shutil
+import hashlib
+import tempfile
+
+from azuma.fileio import place_file
+
+DEFAULT_CACHE_SIZE = 10 * 1024 ** 3  # 10 GiB
+
+
+class TranscodeCache:
+    """转码结果缓存
+
+    以源文件内容、目标音质与编码参数为键保存转码后的文件，多个仓库及多次提交之间共享。
+    命中时更新文件修改时间，超过容量时按修改时间淘汰最久未使用的文件。
+    缓存与仓库中的文件只会被替换或删除，不会被原地修改，因此两者之间使用硬链接。
+    """
+
+    def __init__(self, path: str, max_size: int = DEFAULT_CACHE_SIZE):
+        self.__path = os.path.abspath(path)
+        self.max_size = max_size  # Max total size in bytes
+        os.makedirs(self.__path, exist_ok=True)
+
+    def __reduce__(self):
+        return TranscodeCache, (self.__path, self.max_size)
+
+    @property
+    def path(self):
+        return self.__path
+
+    @staticmethod
+    def key(source_hash: str, quality: int, settings: str) -> str:
+        return hashlib.sha256(f'{source_hash}:{quality}:{settings}'.encode('utf-8')).hexdigest()
+
+    def __entry_path(self, key: str):
+        return os.path.join(self.__path, key[:2], key)
+
+    def get(self, key: str, output_path: str) -> bool:
+        """将缓存的文件放置到output_path，未命中返回False
+        """
+        entry = self.__entry_path(key)
+        try:
+            os.utime(entry)
+        except FileNotFoundError:
+            return False
+        try:
+            place_file(entry, output_path, (), link=True)  # Replaces output_path instead of writing into it
+        except FileNotFoundError:  # Evicted by another process
+            return False
+        return True
+
+    def put(self, key: str, file_path: str):
+        """将文件加入缓存
+        """
+        entry = self.__entry_path(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(entry), prefix='.tmp')
+        os.close(fd)
+        try:
+            place_file(file_path, tmp_path, (), link=True)
+            os.replace(tmp_path, entry)  # Concurrent writers produce identical content
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def evict(self):
+        """淘汰最久未使用的文件，直到总大小不超过max_size
+        """
+        entries = []
+        total = 0
+        for root, _, names in os.walk(self.__path):
+            for name in names:
+                if name.startswith('.tmp'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:  # Evicted by another process sharing the cache
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+                total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:  # Evicted by another process sharing the cache
+                pass
+            total -= size
+
+    def clear(self):
+        shutil.rmtree(self.__path)
+        os.makedirs(self.__path)
@@ -11,31 +11,45 @@
 import os
 import logging
 import argparse
-from mimetypes import guess_type
 
-from azuma import convert, AudioFile, Lyric, Store, Music, Repository, generate_repository_from_store, UUID16, exception, \
-    __version__
+from azuma import __version__
 
 parser = argparse.ArgumentParser(description='Azuma CLI - audio distribution tool', prog='azuma',
                                  formatter_class=argparse.RawDescriptionHelpFormatter, epilog='''
 commands:
   create         create a new store
-  add            add audio to store
+  add            add audio files or directories to store
   remove         remove audio from store
   list           list audio in store
+  search         search audio in store by title, artist, album, description or lyrics
   meta           show meta data of store
+  compact        remove superseded entries from the edit log of store,
+                 or merge old delta lists of the given repository
   commit         commit store to repository
   version        show version
 ''')
 
 parser.add_argument('command', metavar='command', type=str, help='command to execute',
-                    choices=['create', 'add', 'detail', 'edit', 'remove', 'list', 'configure', 'commit', 'version',
-                             'audio', 'lyric']
+                    choices=['create', 'add', 'detail', 'edit', 'remove', 'list', 'search', 'configure', 'commit',
+                             'compact', 'version', 'audio', 'lyric']
                     )
 parser.add_argument('args', metavar='args', type=str, nargs='*', help='arguments for command')
-parser.add_argument('-v', '--verbose', action='repository_true', help='verbose output')
+parser.add_argument('-v', '--verbose', action='store_true', help='verbose output')
 parser.add_argument('--language', type=str, help='language for lyric')
 parser.add_argument('--original', type=bool, help='original lyric')
+parser.add_argument('-j', '--jobs', type=int,
+                    help='number of workers used to add or commit (default: the thread pool default to add, 1 to commit)')
+parser.add_argument('--limit', type=int, help='max number of items to list')
+parser.add_argument('--offset', type=int, default=0, help='number of items to skip when listing')
+parser.add_argument('--sort', type=str, choices=['title', 'artist', 'album', 'num', 'time'], help='sort key of list')
+parser.add_argument('--reverse', action='store_true', help='list in descending order')
+parser.add_argument('--title', type=str, help='only list items whose title contains this')
+parser.add_argument('--artist', type=str, help='only list items whose artist contains this')
+parser.add_argument('--album', type=str, help='only list items whose album contains this')
+parser.add_argument('--keep', type=int, default=10, help='number of latest delta lists kept when compacting')
+parser.add_argument('--codec', type=str, help='compression of the lists when committing, eg. xz:9, xz:6e')
+parser.add_argument('--lyric-codec', type=str, help='compression of the lyrics when committing, eg. xz, zlib:9:azml1')
+parser.add_argument('--profile', type=str, metavar='FILE', help='write timings of each phase to FILE as a Chrome trace')
 
 
 def main(args=None):
@@ -50,29 +64,64 @@ def main(args=None):
 
     if args.command == 'version':
         print(f'Azuma v{__version__}')
-    elif args.command == 'create':
+        return
+
+    from azuma import profiling  # Spans are no-ops unless enabled
+    if args.profile:
+        profiling.enable()
+    try:
+        run(args)
+    finally:
+        if args.profile:
+            profiling.write(args.profile)
+
+
+def run(args):
+    # Imported here so that `azuma version` does not load SQLAlchemy, pydub and mutagen
+    from azuma.store import Store
+    from azuma.music import Music
+    from azuma.lyric import Lyric
+    from azuma.uuid import UUID16
+
+    if args.command == 'create':
         if os.path.exists(args.args[0]):
             raise FileExistsError(f'{args.args[0]} already exists')
         store = Store(args.args[0])
+    elif args.command == 'compact' and args.args:
+        from azuma.repository import Repository
+        print(f'Merged {Repository(args.args[0]).compact(keep=args.keep)} delta lists')
     else:
         store = Store(os.getcwd())
         if args.command == 'add':
-            music = Music(args.args[0])
-            store.commit_music(music)
-            print(music.info.id)
+            if len(args.args) == 1 and not os.path.isdir(args.args[0]):
+                stored = store.commit_music(Music(args.args[0]))
+                print(stored.id)
+            else:  # Directories or several files are imported in one transaction
+                for stored in store.import_many(args.args, jobs=args.jobs):
+                    print(stored.id, stored.title)
         elif args.command == 'remove':
             store.delete_music(UUID16(args.args[0]))
         elif args.command == 'list':
             print('UUID Title Artist')
-            for uuid, title, artist in store.all_items():
-                print(str(uuid), title, ','.join(artist))
+            for uuid, title, artist in store.all_items(limit=args.limit, offset=args.offset, sort=args.sort,
+                                                       reverse=args.reverse, title=args.title, artist=args.artist,
+                                                       album=args.album):
+                print(str(uuid), title, ','.join(artist or []))
+        elif args.command == 'search':
+            print('UUID Title Artist')
+            for uuid, title, artist in store.search(' '.join(args.args), limit=args.limit or 20):
+                print(str(uuid), title, ','.join(artist or []))
         elif args.command == 'configure':
             if args.args[0] in ['name', 'maintainer', 'description']:
                 store.config(args.args[0], args.args[1])
             else:
                 raise ValueError(f'{args.args[0]} is not a valid configuration key')
         elif args.command == 'commit':
-            generate_repository_from_store(args.args[0], store)
+            from azuma.repository import generate_repository_from_store
+            generate_repository_from_store(args.args[0], store, jobs=args.jobs or 1, codec=args.codec,
+                                           lyric_codec=args.lyric_codec)
+        elif args.command == 'compact':
+            print(f'Removed {store.compact()} edit log entries')
         elif args.command == 'detail':
             print(f'UUID: {store.id}')
             print(f'Name: {store.name}')
@@ -86,6 +135,7 @@ def main(args=None):
             elif key == 'artist':
                 music.info.artist = value.split(',')
             elif key == 'cover':
+                from mimetypes import guess_type
                 with open(value, 'rb') as f:
                     music.info.cover = guess_type(value)[0], f.read()
             elif key in ['type', 'num']:
@@ -0,0 +1,146 @@
+# Azuma Python Module https://azuma.sorasky.in/
+# Copyright (C) 2022  Sora
+# ALL RIGHTS RESERVED.
+#
+# The module is a part of Azuma Repository Manager Module.
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+"""仓库元数据与歌词的压缩格式
+
+格式以字符串表示并记录在仓库头部：
+
+    xz              xz，预设6(与lzma.open相同)
+    xz:<0-9>[e]     xz，指定预设，e为极限模式
+    zlib[:<0-9>]    zlib，默认级别9
+    zlib:<0-9>:azml1
+                    zlib，使用内置的歌词字典AZML_DICTIONARY，适合大量很小的.azml文件
+
+解压时根据数据本身判断格式，不需要知道压缩时使用的格式。
+"""
+
+import lzma
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from azuma.exception import InvalidCodecException
+
+XZ_MAGIC = b'\xfd7zXZ\x00'
+XZ_CHUNK_SIZE = 1024 * 1024  # Min input of each xz stream when compressing with several threads
+XZ_DICT_SIZES = [1 << 18, 1 << 20, 1 << 21, 1 << 22, 1 << 22, 1 << 23, 1 << 23, 1 << 24, 1 << 25, 1 << 26]  # Of presets
+XZ_MIN_DICT_SIZE = 4096
+
+# Preset dictionary for .azml lyrics, the common JSON skeleton of Lyric.export.
+# Never change an existing dictionary, add a new one with a new name instead.
+AZML_DICTIONARY = (
+    '{"artist": null, "creator": null, "offset": 0, "orig": false, "lang": "zh-CN", "version": 1, '
+    '"lyrics": [{"time": "00:00.00", "word": ""}, {"time": "00:00.00", "word": "\\u'
+    '"}, {"time": "01:0'
+    '"}, {"time": "02:0'
+    '"}, {"time": "03:0'
+    '"}, {"time": "00:'
+    '"}, {"time": "01:'
+    '"}, {"time": "02:'
+    '"}, {"time": "03:'
+    '"}, {"time": "0'
+    '"}, {"time": "'
+).encode('utf-8')
+DICTIONARIES = {'azml1': AZML_DICTIONARY}
+_DICTIONARY_IDS = {zlib.adler32(content): content for content in DICTIONARIES.values()}  # Recorded in zlib headers
+
+
+class Codec:
+    """压缩格式
+    """
+
+    name = None
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: bytes) -> bytes:
+        return decompress(data)
+
+    def __repr__(self):
+        return f'<Codec {self.name}>'
+
+
+class XzCodec(Codec):
+    def __init__(self, preset: int = 6, extreme: bool = False, threads: int = 1):
+        self.preset = preset
+        self.extreme = extreme
+        self.threads = threads  # Large inputs are split into streams compressed in parallel
+        self.name = 'xz' if preset == 6 and not extreme else f'xz:{preset}{"e" if extreme else ""}'
+
+    def __compress(self, data) -> bytes:
+        # A dictionary larger than the input only costs time to allocate, up to 64 MiB for small lyrics
+        dict_size = min(XZ_DICT_SIZES[self.preset], max(len(data), XZ_MIN_DICT_SIZE))
+        return lzma.compress(data, filters=[{
+            'id': lzma.FILTER_LZMA2,
+            'preset': self.preset | (lzma.PRESET_EXTREME if self.extreme else 0),
+            'dict_size': dict_size,
+        }])
+
+    def compress(self, data: bytes) -> bytes:
+        if self.threads <= 1 or len(data) < 2 * XZ_CHUNK_SIZE:
+            return self.__compress(data)
+        # xz decoders read concatenated streams as one file
+        size = max(XZ_CHUNK_SIZE, -(-len(data) // self.threads))
+        chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:  # lzma releases the GIL
+            return b''.join(executor.map(self.__compress, chunks))
+
+
+class ZlibCodec(Codec):
+    def __init__(self, level: int = 9, dictionary: str = None):
+        if dictionary is not None and dictionary not in DICTIONARIES:
+            raise InvalidCodecException(f'zlib:{level}:{dictionary}')
+        self.level = level
+        self.dictionary = dictionary
+        self.name = f'zlib:{level}' + (f':{dictionary}' if dictionary else '')
+
+    def compress(self, data: bytes) -> bytes:
+        if self.dictionary is None:
+            return zlib.compress(data, self.level)
+        compressor = zlib.compressobj(self.level, zdict=DICTIONARIES[self.dictionary])
+        return compressor.compress(data) + compressor.flush()
+
+
+def get_codec(name: str = None, threads: int = 1) -> Codec:
+    """根据名称返回压缩格式，名称为空时返回默认的xz
+    """
+    if not name:
+        return XzCodec(threads=threads)
+    parts = name.split(':')
+    try:
+        if parts[0] == 'xz' and len(parts) <= 2:
+            preset = parts[1] if len(parts) == 2 else '6'
+            extreme = preset.endswith('e')
+            preset = int(preset[:-1] if extreme else preset)
+            if 0 <= preset <= 9:
+                return XzCodec(preset, extreme, threads)
+        elif parts[0] == 'zlib' and len(parts) <= 3:
+            level = int(parts[1]) if len(parts) >= 2 else 9
+            if 0 <= level <= 9:
+                return ZlibCodec(level, parts[2] if len(parts) == 3 else None)
+    except ValueError:
+        pass
+    raise InvalidCodecException(name)
+
+
+def decompress(data: bytes) -> bytes:
+    """解压xz或zlib数据，使用预设字典的zlib数据按其头部记录的字典ID选择字典
+    """
+    if data.startswith(XZ_MAGIC):
+        return lzma.decompress(data)
+    if len(data) >= 2 and data[0] & 0x0f == 8 and (data[0] << 8 | data[1]) % 31 == 0:  # zlib header
+        if data[1] & 0x20:  # FDICT
+            dictionary = _DICTIONARY_IDS.get(int.from_bytes(data[2:6], 'big'))
+            if dictionary is None:
+                raise InvalidCodecException('zlib with unknown dictionary')
+            decompressor = zlib.decompressobj(zdict=dictionary)
+            return decompressor.decompress(data) + decompressor.flush()
+        return zlib.decompress(data)
+    raise InvalidCodecException('unknown')
@@ -135,9 +135,27 @@ class InvalidStoreException(AzumaException):
         return f'<InvalidStoreException: The store "{self.path}" is invalid>'
 
 
+class StoreVersionIncompatibleException(AzumaException):
+    def __init__(self, path, schema_version):
+        self.path = path
+        self.schema_version = schema_version
+
+    def __repr__(self):
+        return f'<StoreVersionIncompatibleException: The database schema version "{self.schema_version}" of store ' \
+               f'"{self.path}" is newer than the current azuma-cli>'
+
+
 class RepositoryNotChangedException(AzumaException):
     def __init__(self, path):
         self.path = path
 
     def __repr__(self):
         return f'<RepositoryNotChangedException: The repository "{self.path}" is not changed>'
+
+
+class InvalidCodecException(AzumaException):
+    def __init__(self, codec):
+        self.codec = codec
+
+    def __repr__(self):
+        return f'<InvalidCodecException: Unknown or unsupported codec "{self.codec}">'
@@ -8,7 +8,6 @@
 # the Free Software Foundation; either version 3 of the License, or
 # (at your option) any later version.
 
-from mutagen import File as MutaFile
 from .exception import FileImportException, InvalidQualityException
 import os
 
@@ -31,24 +30,102 @@ class AudioFile:
 
     UNKNOWN = -1  # Unknown
 
-    def __init__(self, path):
+    def __init__(self, path, probe: dict = None):
         self.path = os.path.abspath(path)  # Absolute path of the file
-        try:
-            self.muta_file = MutaFile(self.path)  # Mutagen file object
-        except Exception as e:
-            raise FileImportException(self.path, e)
-        self.mpeg_info = self.muta_file.info  # 音频采样信息
-        self.bitrate = self.mpeg_info.bitrate  # Bit rate
-        self.sample_rate = self.mpeg_info.sample_rate  # Sample rate
-        self.size = os.path.getsize(self.path)  # File sizq
+        self.digests: dict = {}  # Known digests of the file, eg. {'md5': ..., 'sha256': ...}
+        self.__muta_file = None
+        self.__size = None
+        self.__probe = probe  # Cached probe result, used while the file is unchanged
+        self.__probe_checked = False
+
+    def __reduce__(self):
+        # Mutagen objects are not sent between processes, the file is reopened instead
+        return AudioFile, (self.path, self.__probe), {'digests': self.digests}
+
+    @property
+    def muta_file(self):
+        """Mutagen file object, parsed on first access
+        """
+        if self.__muta_file is None:
+            from mutagen import File as MutaFile
+            try:
+                muta_file = MutaFile(self.path)
+            except Exception as e:
+                raise FileImportException(self.path, e)
+            if muta_file is None:  # Unknown file type
+                raise FileImportException(self.path, None)
+            self.__muta_file = muta_file
+        return self.__muta_file
+
+    def __cached(self, key):
+        """从缓存的探测结果中读取，文件修改时间或大小变化时缓存失效
+        """
+        if self.__probe is None:
+            return None
+        if not self.__probe_checked:
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                stat = None
+            if stat is None or stat.st_mtime_ns != self.__probe['mtime'] or stat.st_size != self.__probe['size']:
+                self.__probe = None
+                return None
+            self.__probe_checked = True
+        return self.__probe[key]
+
+    def probe(self) -> dict:
+        """返回文件的探测结果，可保存后通过AudioFile(path, probe)重建
+        """
+        stat = os.stat(self.path)
+        return {
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'mime': self.__cached('mime') or list(self.muta_file.mime),
+            'bitrate': self.bitrate,
+            'sample_rate': self.sample_rate,
+            'length': self.length,
+            'meta_type': list(self.meta_type),
+        }
+
+    @property
+    def mpeg_info(self):
+        """音频采样信息
+        """
+        return self.muta_file.info
+
+    @property
+    def bitrate(self):
+        cached = self.__cached('bitrate')
+        return self.mpeg_info.bitrate if cached is None else cached
+
+    @property
+    def sample_rate(self):
+        cached = self.__cached('sample_rate')
+        return self.mpeg_info.sample_rate if cached is None else cached
+
+    @property
+    def length(self):
+        """Duration in seconds
+        """
+        cached = self.__cached('length')
+        return self.mpeg_info.length if cached is None else cached
+
+    @property
+    def size(self):
+        """File size
+        """
+        if self.__size is None:
+            self.__size = os.path.getsize(self.path)
+        return self.__size
 
     @property
     def file_type(self):
         """文件类型
         """
-        if 'audio/mp3' in self.muta_file.mime:  # MP3
+        mime = self.__cached('mime') or self.muta_file.mime
+        if 'audio/mp3' in mime:  # MP3
             return AudioFile.MP3
-        elif 'audio/flac' in self.muta_file.mime:  # FLAC
+        elif 'audio/flac' in mime:  # FLAC
             return AudioFile.FLAC
         else:
             return AudioFile.UNKNOWN
@@ -57,6 +134,9 @@ class AudioFile:
     def meta_type(self):
         """标签类型
         """
+        cached = self.__cached('meta_type')
+        if cached is not None:
+            return tuple(cached)
         if hasattr(self.muta_file, 'ID3'):  # ID3格式
             return AudioFile.ID3, '.'.join([str(i) for i in self.muta_file.tags.version])
         elif self.muta_file.__class__.__name__ == 'FLAC' or self.muta_file.__class__.__name__ == 'OggFileType':  # Vorbis format (flac and ogg)
@@ -0,0 +1,154 @@
+# Azuma Python Module https://azuma.sorasky.in/
+# Copyright (C) 2022  Sora
+# ALL RIGHTS RESERVED.
+#
+# The module is a part of Azuma Repository Manager Module.
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+import os
+import errno
+import shutil
+import hashlib
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+CHUNK_SIZE = 1024 * 1024  # 1 MiB
+FICLONE = 0x40049409  # Linux ioctl cloning a whole file, supported by btrfs, XFS, etc.
+
+
+def digest_file(path: str, algorithms=('md5',)) -> dict:
+    """流式计算文件摘要，返回{'size': 文件大小, 算法名: 十六进制摘要}
+    """
+    hashes = {name: hashlib.new(name) for name in algorithms}
+    size = 0
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb') as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            for h in hashes.values():
+                h.update(view[:n])
+            size += n
+    result = {name: h.hexdigest() for name, h in hashes.items()}
+    result['size'] = size
+    return result
+
+
+def _copy_offload(src: str, dst: str):
+    """由内核完成复制，数据不经过用户态
+    """
+    if not hasattr(os, 'copy_file_range'):
+        shutil.copyfile(src, dst)
+        return
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            while os.copy_file_range(fsrc.fileno(), fdst.fileno(), CHUNK_SIZE * 64):
+                pass
+        except OSError:  # Not supported between these filesystems
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+            shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+
+
+def copy_file(src: str, dst: str, algorithms=('md5',), known: dict = None) -> dict:
+    """复制文件并在同一次读取中计算摘要，返回值同digest_file。
+    known为已知的摘要，若已包含全部算法则直接使用内核复制
+    """
+    if all((known or {}).get(name) for name in algorithms):
+        _copy_offload(src, dst)
+        result = {name: known[name] for name in algorithms}
+        result['size'] = os.path.getsize(dst)
+        return result
+    hashes = {name: hashlib.new(name) for name in algorithms}
+    size = 0
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        while True:
+            n = fsrc.readinto(buffer)
+            if not n:
+                break
+            for h in hashes.values():
+                h.update(view[:n])
+            fdst.write(view[:n])
+            size += n
+    result = {name: h.hexdigest() for name, h in hashes.items()}
+    result['size'] = size
+    return result
+
+
+def reflink(src: str, dst: str) -> bool:
+    """以写时复制方式克隆文件，两者共享数据块直到其中一个被修改。文件系统不支持时返回False
+    """
+    if fcntl is None:
+        return False
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+        except OSError:
+            pass
+    os.remove(dst)
+    return False
+
+
+def hardlink(src: str, dst: str) -> bool:
+    """创建硬链接，不在同一文件系统或不支持时返回False
+    """
+    try:
+        os.link(src, dst)
+        return True
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            raise
+        return False
+
+
+def place_file(src: str, dst: str, algorithms=('md5',), known: dict = None, link: bool = False) -> dict:
+    """将src放置到dst，返回值同digest_file。
+    依次尝试reflink、硬链接(仅当link为True)与复制，复制时在同一次读取中计算摘要。
+    先写入临时文件再替换dst，已有的dst会被替换而不是原地修改，所以与之硬链接的文件不受影响
+    """
+    tmp_path = f'{dst}.tmp{os.getpid()}'
+    try:
+        if reflink(src, tmp_path) or (link and hardlink(src, tmp_path)):
+            if all((known or {}).get(name) for name in algorithms):
+                result = {name: known[name] for name in algorithms}
+                result['size'] = os.path.getsize(tmp_path)
+            else:
+                result = digest_file(tmp_path, algorithms)
+        else:
+            result = copy_file(src, tmp_path, algorithms, known)
+        os.replace(tmp_path, dst)
+        if os.path.exists(tmp_path):  # dst was already a link to src, rename leaves both names
+            os.remove(tmp_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return result
+
+
+def write_md5(path: str, md5: str):
+    """写入.md5校验文件
+    """
+    with open(path + '.md5', 'w') as f:
+        f.write(md5)
+
+
+def write_atomic(path: str, data: bytes):
+    """先写入临时文件再替换，读者不会看到写了一半的文件
+    """
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
@@ -0,0 +1,50 @@
+# Azuma Python Module https://azuma.sorasky.in/
+# Copyright (C) 2022  Sora
+# ALL RIGHTS RESERVED.
+#
+# The module is a part of Azuma Repository Manager Module.
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+import io
+import logging
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional, thumbnails are not generated without it
+    Image = None
+
+THUMBNAIL_SIZES = (128, 512)  # 缩略图边长
+THUMBNAIL_MIME = 'image/jpeg'
+_warned = False
+
+
+def make_thumbnails(content: bytes, sizes=THUMBNAIL_SIZES) -> dict[int, bytes]:
+    """生成封面缩略图，返回{边长: JPEG内容}。只生成小于原图的尺寸，未安装Pillow时返回空字典
+    """
+    global _warned
+    if Image is None:
+        if not _warned:  # Once per process
+            logging.warning('Pillow is not installed, cover thumbnails are not generated')
+            _warned = True
+        return {}
+    try:
+        image = Image.open(io.BytesIO(content))
+        image.load()
+    except Exception as e:
+        logging.warning(f'Cannot read cover image: {e}')
+        return {}
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    result = {}
+    for size in sizes:
+        if size >= max(image.size):
+            continue
+        thumbnail = image.copy()
+        thumbnail.thumbnail((size, size))
+        output = io.BytesIO()
+        thumbnail.save(output, 'JPEG', quality=85, optimize=True)
+        result[size] = output.getvalue()
+    return result
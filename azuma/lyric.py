@@ -11,7 +11,7 @@
 import re
 import os
 import json
-import lzma
+from azuma.codec import Codec, get_codec, decompress
 from azuma.exception import InvalidLRCLineException
 
 
@@ -40,8 +40,8 @@ class Lyric:
 
         if path is not None:
             self.path = os.path.abspath(path)
-            with lzma.open(self.path, 'r') as f:
-                data = json.loads(f.read())
+            with open(self.path, 'rb') as f:
+                data = json.loads(decompress(f.read()))  # xz or zlib, see azuma.codec
                 self.artist = data['artist']
                 self.creator = data['creator']
                 self.offset = data['offset']
@@ -50,25 +50,16 @@ class Lyric:
                 self.version = data['version']
                 self.lyrics = [(line['time'], line['word']) for line in data['lyrics']]
 
-    def export(self, path: str):
+    def export(self, path: str, codec: Codec = None):
         """
         Export to lyrics LZMA extracted JSON file.
         Extension name should be ".azml".
+        codec is the compression of the file, xz at the default preset if not specified.
         """
         path = os.path.abspath(path)
-        with lzma.open(path, 'w') as f:
-            f.write(json.dumps({
-                'artist': self.artist,
-                'creator': self.creator,
-                'offset': self.offset,
-                'orig': self.orig,
-                'lang': self.lang,
-                'version': self.version,
-                'lyrics': [{
-                    'time': lyric[0],
-                    'word': lyric[1]
-                } for lyric in self.lyrics]
-            }).encode())
+        codec = codec or get_codec()
+        with open(path, 'wb') as f:
+            f.write(codec.compress(json.dumps(self.to_dict()).encode()))
         self.path = path
 
     @staticmethod
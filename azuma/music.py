@@ -24,11 +24,47 @@ class MusicInfo:
         self.title: str = None  # 曲名
         self.artist: list[str] = None  # 艺术家
         self.album: str = None  # 专辑
-        self.cover: tuple[str, bytes] = None, None  # 专辑封面(MIME, 封面内容)
+        self.__cover: tuple[str, bytes] = None, None  # 专辑封面(MIME, 封面内容)
+        self.__cover_loader = None  # 延迟载入封面的函数
+        self.cover_hash: str = None  # 封面内容的SHA-256，未知时为None
         self.type: int = None  # 歌曲类型
         self.num: int = None  # 歌曲在专辑内的位置
         self.description: str = None  # 备注
 
+    def __getstate__(self):
+        # The loader may hold a database session, so the cover is loaded before pickling
+        self.__load_cover()
+        return self.__dict__
+
+    def __load_cover(self):
+        if self.__cover_loader is not None:
+            self.__cover = self.__cover_loader()
+            self.__cover_loader = None
+
+    @property
+    def cover(self) -> tuple[str, bytes]:
+        """专辑封面(MIME, 封面内容)，延迟载入时在首次访问时读取
+        """
+        self.__load_cover()
+        return self.__cover
+
+    @cover.setter
+    def cover(self, value: tuple[str, bytes]):
+        self.__cover = value
+        self.__cover_loader = None
+        self.cover_hash = None
+
+    @property
+    def cover_loaded(self) -> bool:
+        return self.__cover_loader is None
+
+    def set_cover_loader(self, loader, cover_hash: str = None):
+        """设置延迟载入封面的函数，loader返回(MIME, 封面内容)
+        """
+        self.__cover = None, None
+        self.__cover_loader = loader
+        self.cover_hash = cover_hash
+
     @staticmethod
     def load_from_file(file: AudioFile):
         """从AudioFile对象对应的文件载入单曲信息并导入新的MusicInfo对象
@@ -49,8 +85,8 @@ class MusicInfo:
                 tmp.album = m['TALB'].text[0]
             except (KeyError, IndexError):
                 pass
-            apic_name = [n for n in list(m) if n.startswith('APIC:')][0]
             try:
+                apic_name = [n for n in list(m) if n.startswith('APIC:')][0]
                 tmp.cover = m[apic_name].mime, m[apic_name].data
             except (KeyError, IndexError):
                 pass
@@ -113,14 +149,18 @@ class MusicFileList:
             'original': self.original.path if self.original else None
         }
 
-    def from_dict(self, d: dict):
-        """从字典导入
+    def from_dict(self, d: dict, info: dict = None):
+        """从字典导入，info为各文件已知的摘要与探测结果
         """
-        self.normal = AudioFile(d['normal']) if d['normal'] else None
-        self.better = AudioFile(d['better']) if d['better'] else None
-        self.high = AudioFile(d['high']) if d['high'] else None
-        self.best = AudioFile(d['best']) if d['best'] else None
-        self.original = AudioFile(d['original']) if d['original'] else None
+        info = info or {}
+        for quality in ['normal', 'better', 'high', 'best', 'original']:
+            if d[quality]:
+                file_info = dict(info.get(quality) or {})
+                file = AudioFile(d[quality], probe=file_info.pop('probe', None))
+                file.digests = file_info
+                self.__dict__[quality] = file
+            else:
+                self.__dict__[quality] = None
 
     def highest_quality(self):
         if self.original is not None:
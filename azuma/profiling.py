@@ -0,0 +1,116 @@
+# Azuma Python Module https://azuma.sorasky.in/
+# Copyright (C) 2022  Sora
+# ALL RIGHTS RESERVED.
+#
+# The module is a part of Azuma Repository Manager Module.
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+"""各阶段耗时记录，输出Chrome trace格式(chrome://tracing、Perfetto)
+
+    with span('encode', song=song_id, tier='high'):
+        ...
+
+未启用时span返回空的上下文管理器，不记录任何内容。
+"""
+
+import os
+import json
+import time
+import threading
+from contextlib import nullcontext
+
+_events = None  # Recorded events, None when disabled
+_lock = threading.Lock()
+_NULL_SPAN = nullcontext()
+
+
+class _Span:
+    __slots__ = ('name', 'args', 'start')
+
+    def __init__(self, name: str, args: dict):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end = time.perf_counter_ns()
+        event = {
+            'name': self.name,
+            'cat': self.name.split('.', 1)[0],
+            'ph': 'X',
+            'ts': self.start / 1000,  # Microseconds
+            'dur': (end - self.start) / 1000,
+            'pid': os.getpid(),
+            'tid': threading.get_native_id(),
+            'args': {key: str(value) for key, value in self.args.items()},
+        }
+        events = _events
+        if events is not None:
+            with _lock:
+                events.append(event)
+
+
+def span(name: str, **args):
+    """记录with块的耗时，args为附加的标签，如曲目ID、音质
+    """
+    if _events is None:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def enable():
+    global _events
+    if _events is None:
+        _events = []
+
+
+def disable():
+    global _events
+    _events = None
+
+
+def enabled() -> bool:
+    return _events is not None
+
+
+def collect() -> list[dict]:
+    """取出已记录的事件
+    """
+    global _events
+    with _lock:
+        events = _events or []
+        if _events is not None:
+            _events = []
+    return events
+
+
+def extend(events: list[dict]):
+    """加入在其他进程中记录的事件
+    """
+    if _events is not None:
+        with _lock:
+            _events.extend(events)
+
+
+def run_traced(func, *args):
+    """在子进程中启用记录并执行func，返回(func的返回值, 记录的事件)
+    """
+    global _events
+    _events = []  # Forked workers inherit the events of the parent
+    try:
+        return func(*args), collect()
+    finally:
+        disable()
+
+
+def write(path: str):
+    """将已记录的事件写入Chrome trace文件
+    """
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': collect(), 'displayTimeUnit': 'ms'}, f)
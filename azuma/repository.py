@@ -18,19 +18,33 @@ import hashlib
 import json
 from distutils.version import LooseVersion
 from typing import Union
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 
 from azuma.exception import InvalidRepositoryException, FileOrDirectoryExistsException, HeaderProtectedException, \
     HeaderNotFoundException, RepositoryIdNotMatchException, RepositoryVersionIncompatibleException, RepositoryLaterThanNowException, \
-    RepositoryNotChangedException
+    RepositoryNotChangedException, InvalidCodecException
 from azuma.file import AudioFile
 from azuma.music import Music, MusicInfo, MusicFileList
 from azuma.lyric import Lyric
 from azuma.store import Store
 from azuma.uuid import UUID16
-from azuma.audio import convert
+from azuma.audio import convert_many, get_encoder_settings
+from azuma.cache import TranscodeCache
+from azuma.codec import Codec, XzCodec, get_codec, decompress
+from azuma.fileio import place_file, digest_file, write_md5, write_atomic
+from azuma.image import make_thumbnails, THUMBNAIL_SIZES
+from azuma.profiling import span
+from azuma import profiling
 from azuma.utils import STORE_VERSION
 
 HEADERS_PROTECTED = ['id', 'version']
+CODEC_HEADERS = ['codec', 'lyric_codec']  # Compression of the lists and lyrics, see azuma.codec
+CATALOG_PATH = 'meta/list/catalog'  # Catalog shards <n>.xz and their index
+SHARD_SIZE = 1000  # Max number of songs in a catalog shard
+SHARD_SEPARATOR = lzma.compress(b'\n\n')  # xz stream put between shards in all.xz
+STAGING_PATH = '.staging'  # Work directory of commits, in the repository so files are moved in by rename
+JOURNAL_NAME = 'journal'
 
 
 class Edit:
@@ -42,106 +56,356 @@ class Edit:
         self.data = data
 
 
+def _write_cover(path: str, cover_hash: str, content: bytes) -> list[int]:
+    """
+    将封面及其缩略图写入仓库共享的cover目录，相同内容只写入一次。返回已有的缩略图尺寸。
+    封面已存在但缺少缩略图时(如写入时未安装Pillow)补充生成
+    """
+    cover_path = os.path.join(path, 'cover', cover_hash)
+    missing = [size for size in THUMBNAIL_SIZES if not os.path.exists(f'{cover_path}@{size}')]
+    if missing:  # Sizes not smaller than the cover are never written, so small covers are decoded each time
+        for size, thumbnail in make_thumbnails(content, missing).items():
+            write_atomic(f'{cover_path}@{size}', thumbnail)
+    if not os.path.exists(cover_path):
+        write_atomic(cover_path, content)  # Written last, marks the cover as complete
+    return [size for size in THUMBNAIL_SIZES if os.path.exists(f'{cover_path}@{size}')]
+
+
+def _read_cover(mime: str, path: str) -> tuple[str, bytes]:
+    with open(path, 'rb') as f:
+        return mime, f.read()
+
+
+def _read_compressed(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return decompress(f.read())
+
+
+def _verified(path: str) -> bool:
+    """文件与其.md5校验文件都存在且一致，即上次提交中断前已完成
+    """
+    if not os.path.exists(path) or not os.path.exists(path + '.md5'):
+        return False
+    with open(path + '.md5') as f:
+        return f.read().strip() == digest_file(path)['md5']
+
+
+def _fingerprint(music: Music) -> str:
+    """曲目音频的指纹，与暂存区日志中记录的不同时，暂存的文件已过期
+    """
+    tiers = []
+    for quality in range(AudioFile.NORMAL, music.files.highest_quality() + 1):
+        file = music.files.get_file_from_quality(quality)
+        if file is None:
+            tiers.append(get_encoder_settings(quality, 'mp3'))
+        else:
+            stat = os.stat(file.path)
+            tiers.append(file.digests.get('sha256') or f'{file.path}:{stat.st_size}:{stat.st_mtime_ns}')
+    return hashlib.sha256(json.dumps(tiers).encode()).hexdigest()
+
+
+def _linkable(file: AudioFile, link_from: str) -> bool:
+    """文件属于link_from目录(Store的files目录)且摘要已知时才能硬链接到仓库。
+    其他文件可能被其所有者修改，如mutagen原地保存标签，链接后会改变已发布的文件
+    """
+    return link_from is not None and bool(file.digests.get('md5')) and \
+        os.path.abspath(file.path).startswith(os.path.join(os.path.abspath(link_from), ''))
+
+
+def _commit_music(path: str, music: Music, cache: TranscodeCache = None, lyric_codec: Codec = None,
+                  work_path: str = None, link_from: str = None) -> dict:
+    """
+    处理单曲的转码、复制、MD5与歌词导出，返回该曲目在列表中的信息。
+    曲目写入work_path(默认为path)下的music目录，其中已通过.md5校验的音质不再重新生成。
+    link_from目录下的音频文件使用硬链接，其他文件使用reflink或复制。
+    在进程池中执行，因此为模块级函数
+    """
+    logging.debug(f'Processing Music {music.info.title}: {music.info.id}')
+    song_id = str(music.info.id)
+    music_path = os.path.join(work_path or path, 'music/' + song_id)
+    os.makedirs(os.path.join(music_path, 'files'), exist_ok=True)
+    shutil.rmtree(os.path.join(music_path, 'lyrics'), ignore_errors=True)  # Cheap, always exported again
+    os.mkdir(os.path.join(music_path, 'lyrics'))
+    tmp = {'id': music.info.id, 'title': music.info.title}
+    if music.info.artist:
+        tmp['artist'] = json.dumps(music.info.artist)
+    if music.info.album:
+        tmp['album'] = music.info.album
+    if music.info.type is not None:
+        tmp['type'] = str(music.info.type)
+    if music.info.num is not None:
+        tmp['num'] = str(music.info.num)
+    if music.info.description:
+        tmp['description'] = music.info.description
+    cover_mime, cover = music.info.cover
+    if cover:
+        cover_hash = music.info.cover_hash or hashlib.sha256(cover).hexdigest()
+        tmp['cover_hash'] = cover_hash
+        tmp['cover_mime'] = cover_mime
+        with span('cover', song=song_id):
+            sizes = _write_cover(path, cover_hash, cover)
+        if sizes:
+            tmp['cover_sizes'] = ','.join(str(size) for size in sizes)
+    highest_quality = music.files.highest_quality()
+    source = music.files.get_file_from_quality(highest_quality)
+    source_hash = None
+    # Existing files are linked from the store, or copied with their digests computed in the same pass
+    for quality in range(AudioFile.NORMAL, highest_quality + 1):
+        file = music.files.get_file_from_quality(quality)
+        if file is not None:
+            output_path = os.path.join(music_path,
+                                       f'files/{AudioFile.get_quality_str(quality)}{os.path.splitext(file.path)[1]}')
+            if _verified(output_path):  # Finished by an interrupted commit
+                if file is source:
+                    source_hash = file.digests.get('sha256')
+                continue
+            algorithms = ('md5', 'sha256') if file is source and cache is not None else ('md5',)
+            with span('copy', song=song_id, tier=AudioFile.get_quality_str(quality), digests=','.join(algorithms)):
+                digests = place_file(file.path, output_path, algorithms, known=file.digests,
+                                     link=_linkable(file, link_from))
+            write_md5(output_path, digests['md5'])
+            if file is source:
+                source_hash = digests.get('sha256')
+
+    # Missing qualities are converted from one decode of the highest quality file
+    outputs = {}
+    for quality in range(AudioFile.NORMAL, highest_quality):
+        if music.files.get_file_from_quality(quality) is None:
+            output_path = os.path.join(music_path, f'files/{AudioFile.get_quality_str(quality)}.mp3')
+            if not _verified(output_path):
+                # Left by an interrupted commit, possibly linked to a cache entry, so removed instead of overwritten
+                for name in (output_path + '.md5', output_path):
+                    if os.path.exists(name):
+                        os.remove(name)
+                outputs[quality] = output_path
+    misses = outputs
+    if cache is not None and outputs:
+        if source_hash is None:  # The source was verified and its digest is not known
+            source_hash = digest_file(source.path, ('sha256',))['sha256']
+        keys = {quality: TranscodeCache.key(source_hash, quality, get_encoder_settings(quality, 'mp3'))
+                for quality in outputs}
+        with span('cache.get', song=song_id):
+            misses = {quality: output_path for quality, output_path in outputs.items()
+                      if not cache.get(keys[quality], output_path)}
+    with span('transcode', song=song_id, tiers=','.join(AudioFile.get_quality_str(quality) for quality in misses)):
+        convert_many(
+            input_file=source,
+            outputs=misses
+        )
+    if cache is not None:
+        for quality, output_path in misses.items():
+            with span('cache.put', song=song_id, tier=AudioFile.get_quality_str(quality)):
+                cache.put(keys[quality], output_path)
+    for quality, output_path in outputs.items():
+        with span('md5', song=song_id, tier=AudioFile.get_quality_str(quality)):
+            write_md5(output_path, digest_file(output_path)['md5'])
+    tmp['quality'] = AudioFile.get_quality_str(highest_quality)
+
+    # Lyrics
+    languages = []
+    with span('lyric', song=song_id):
+        for lyric in music.lyrics:
+            lyric.export(os.path.join(music_path, f'lyrics/{lyric.lang}.azml'), lyric_codec)
+            languages.append(lyric.lang)
+    tmp['lyriclang'] = ','.join(languages)
+    return tmp
+
+
+def _read_journal(staging: str) -> tuple[dict[str, str], dict]:
+    """读取暂存区日志，返回({已暂存的曲目ID: 指纹}, 已完成的提交或None)。
+    中断时写了一半的最后一行被忽略
+    """
+    stages, commit = {}, None
+    journal_path = os.path.join(staging, JOURNAL_NAME)
+    if not os.path.exists(journal_path):
+        return stages, commit
+    with open(journal_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if 'stage' in record:
+                stages[record['stage']] = record['fingerprint']
+            elif 'commit' in record:
+                commit = record
+    return stages, commit
+
+
+def _finish_commit(path: str):
+    """将日志中已完成的提交从暂存区移入仓库并删除暂存区。每一步都可以重复执行，
+    所以在移入过程中被中断的提交可以再次调用完成
+    """
+    staging = os.path.join(path, STAGING_PATH)
+    commit = _read_journal(staging)[1]
+    if commit is None:
+        return
+    trash = os.path.join(staging, 'trash')
+    os.makedirs(trash, exist_ok=True)
+    for name in commit['replace']:  # The header is the last, readers switch to the new lists with it
+        src, dst = os.path.join(staging, name), os.path.join(path, name)
+        if not os.path.exists(src):  # Moved before the interruption
+            continue
+        os.makedirs(os.path.dirname(dst), exist_ok=True)  # eg. the catalog of repositories before sharding
+        if os.path.isdir(src):  # Song directories cannot be replaced by rename
+            if os.path.exists(dst):
+                old = os.path.join(trash, os.path.basename(name))
+                shutil.rmtree(old, ignore_errors=True)
+                os.rename(dst, old)
+            os.rename(src, dst)
+        else:
+            os.replace(src, dst)
+    for name in commit['remove']:
+        target = os.path.join(path, name)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        elif os.path.exists(target):
+            os.remove(target)
+    shutil.rmtree(staging)
+
+
+def _index_catalog(text: str) -> dict[str, tuple[int, int]]:
+    """只查找列表中每首曲目的ID及其所在的位置，返回{ID: (起始, 结束)}
+    """
+    index = {}
+    start = 0
+    while start < len(text):
+        end = text.find('\n\n', start)
+        if end == -1:
+            end = len(text)
+        if text.startswith('id:', start):
+            line_end = text.find('\n', start, end)
+            index[text[start + 3:end if line_end == -1 else line_end].strip()] = (start, end)
+        elif start != end:  # ID is not the first line
+            match = re.search(r'^id:(.*)$', text[start:end], re.MULTILINE)
+            if match:
+                index[match.group(1).strip()] = (start, end)
+        start = end + 2
+    return index
+
+
+def _parse_music(path: str, text: str) -> Music:
+    """解析列表中的一首曲目，封面在访问时才读取
+    """
+    store = Music()
+    store.info = MusicInfo()
+    store.files = MusicFileList()
+    cover_mime = None
+    cover_path = None
+    cover_hash = None
+    music_path = None
+    lines = text.split('\n')
+    for line in lines:
+        if line.startswith('id:'):
+            store.info.id = UUID16(line[3:].strip())
+            music_path = os.path.join(path, 'music/' + str(store.info.id))
+    for line in lines:
+        if line == '':
+            continue
+        key, value = re.match(r'^(.*?):(.*)$', line).groups()
+        if key == 'title':
+            store.info.title = value
+        elif key == 'artist':
+            store.info.artist = json.loads(value)
+        elif key == 'album':
+            store.info.album = value
+        elif key == 'type':
+            store.info.type = int(value)
+        elif key == 'num':
+            store.info.num = int(value)
+        elif key == 'description':
+            store.info.description = value
+        elif key == 'cover_mime':
+            cover_mime = value
+        elif key == 'cover_hash':
+            cover_hash = value
+            cover_path = os.path.join(path, 'cover/' + value)
+        elif key == 'cover':  # Cover of repositories before content addressed covers
+            cover_path = os.path.join(music_path, 'cover/' + value)
+        elif key == 'quality':
+            if value == 'normal':
+                quality = AudioFile.NORMAL
+            elif value == 'better':
+                quality = AudioFile.BETTER
+            elif value == 'high':
+                quality = AudioFile.HIGH
+            elif value == 'best':
+                quality = AudioFile.BEST
+            elif value == 'original':
+                quality = AudioFile.ORIGINAL
+            else:
+                raise InvalidRepositoryException(path)
+
+            if quality >= AudioFile.NORMAL:
+                store.files.normal = AudioFile(os.path.join(music_path, 'files/normal.mp3'))
+            if quality >= AudioFile.BETTER:
+                store.files.better = AudioFile(os.path.join(music_path, 'files/better.mp3'))
+            if quality >= AudioFile.HIGH:
+                store.files.high = AudioFile(os.path.join(music_path, 'files/high.mp3'))
+            if quality >= AudioFile.BEST:
+                store.files.best = AudioFile(os.path.join(music_path, 'files/best.mp3'))
+            if quality >= AudioFile.ORIGINAL:
+                store.files.original = AudioFile(os.path.join(music_path, 'files/original.flac'))
+
+        elif key == 'lyriclang':
+            store.lyrics = [Lyric(os.path.join(music_path, f'lyrics/{lang.strip()}.azml')) for lang in
+                            value.split(',') if lang]
+
+    if cover_path is not None:
+        store.info.set_cover_loader(partial(_read_cover, cover_mime, cover_path), cover_hash)
+    return store
+
+
 class Repository:
     def __init__(self, path: str):
         self.__path = os.path.abspath(path)
         self.__headers = {}
-        self.__musics = []
+        self.__shards: dict[int, str] = {}  # {Shard number: text} of the catalog
+        self.__index: dict[str, tuple[int, int, int]] = {}  # {ID: (shard, start, end)} of each block
+        self.__dirty_shards: set[int] = set()  # Shards to be written on the next commit
+        self.__musics: dict[str, Music] = {}  # Songs already parsed or committed
         self.__edits: list[Edit] = []
         self.__header_edited: bool = False
         if not os.path.isdir(path):
             raise InvalidRepositoryException(path)
+        _finish_commit(self.__path)  # A commit interrupted while moving files in
 
         # Initialize headers
         header_path = os.path.join(path, 'meta/header.xz')
         if not os.path.exists(header_path):
             raise InvalidRepositoryException(path)
         try:
-            with lzma.open(header_path) as f:
-                for line in [line.decode('utf-8').strip() for line in f.readlines()]:
-                    if line == '':  # Empty line
-                        continue
-                    key, value = re.match(r'^(.*?):(.*)$', line).groups()
-                    key, value = key.strip(), value.strip()
-                    if value == '':
-                        value = None
-                    self.__headers[key] = value
-        except (lzma.LZMAError, FileNotFoundError):
+            for line in [line.strip() for line in _read_compressed(header_path).decode('utf-8').splitlines()]:
+                if line == '':  # Empty line
+                    continue
+                key, value = re.match(r'^(.*?):(.*)$', line).groups()
+                key, value = key.strip(), value.strip()
+                if value == '':
+                    value = None
+                self.__headers[key] = value
+        except (lzma.LZMAError, FileNotFoundError, InvalidCodecException):
             raise InvalidRepositoryException(path)
 
-        # Initialize repository
-        repository_text_path = os.path.join(path, 'meta/list/all.xz')
-        if not os.path.exists(repository_text_path):
-            raise InvalidRepositoryException(path)
+        # Initialize repository, songs are parsed when they are accessed
+        catalog_index_path = os.path.join(path, CATALOG_PATH, 'index')
         try:
-            with lzma.open(repository_text_path) as f:
-                repository_text = f.read().decode('utf-8')
-        except (lzma.LZMAError, FileNotFoundError):
+            if os.path.exists(catalog_index_path):
+                with open(catalog_index_path) as f:
+                    shards = [int(line.split(':')[0]) for line in f if line.strip()]
+                for shard in shards:
+                    self.__shards[shard] = _read_compressed(
+                        os.path.join(path, CATALOG_PATH, f'{shard}.xz')).decode('utf-8').strip()
+            else:  # Repositories before sharded catalogs, shards are written on the next commit
+                text = _read_compressed(os.path.join(path, 'meta/list/all.xz')).decode('utf-8').strip()
+                blocks = [text[start:end] for start, end in _index_catalog(text).values()]
+                for shard, i in enumerate(range(0, len(blocks), SHARD_SIZE)):
+                    self.__shards[shard] = '\n\n'.join(blocks[i:i + SHARD_SIZE])
+                self.__dirty_shards = set(self.__shards) or {0}
+        except (lzma.LZMAError, FileNotFoundError, ValueError, InvalidCodecException):
             raise InvalidRepositoryException(path)
-        if repository_text:
-            song_texts = repository_text.split('\n\n')
-            for text in song_texts:
-                store = Music()
-                store.info = MusicInfo()
-                store.files = MusicFileList()
-                lines = text.split('\n')
-                for line in lines:
-                    cover_mime = None
-                    cover = None
-                    if line == '':
-                        continue
-                    key, value = re.match(r'^(.*?):(.*)$', line).groups()
-                    if key == 'id':
-                        store.info.id = UUID16(value)
-                        music_path = os.path.join(path, 'music/' + str(store.info.id))
-                    elif key == 'title':
-                        store.info.title = value
-                    elif key == 'artist':
-                        store.info.artist = json.loads(value)
-                    elif key == 'album':
-                        store.info.album = value
-                    elif key == 'type':
-                        store.info.type = int(value)
-                    elif key == 'num':
-                        store.info.num = int(value)
-                    elif key == 'description':
-                        store.info.description = value
-                    elif key == 'cover_mime':
-                        cover_mime = value
-                    elif key == 'cover':
-                        cover = open(os.path.join(music_path, 'cover/' + value), 'rb').read()
-                    elif key == 'quality':
-                        if value == 'normal':
-                            quality = AudioFile.NORMAL
-                        elif value == 'better':
-                            quality = AudioFile.BETTER
-                        elif value == 'high':
-                            quality = AudioFile.HIGH
-                        elif value == 'best':
-                            quality = AudioFile.BEST
-                        elif value == 'original':
-                            quality = AudioFile.ORIGINAL
-                        else:
-                            raise InvalidRepositoryException(path)
-
-                        if quality >= AudioFile.NORMAL:
-                            store.files.normal = AudioFile(os.path.join(music_path, 'files/normal.mp3'))
-                        if quality >= AudioFile.BETTER:
-                            store.files.better = AudioFile(os.path.join(music_path, 'files/better.mp3'))
-                        if quality >= AudioFile.HIGH:
-                            store.files.high = AudioFile(os.path.join(music_path, 'files/high.mp3'))
-                        if quality >= AudioFile.BEST:
-                            store.files.best = AudioFile(os.path.join(music_path, 'files/best.mp3'))
-                        if quality >= AudioFile.ORIGINAL:
-                            store.files.original = AudioFile(os.path.join(music_path, 'files/original.flac'))
-
-                    elif key == 'lyriclang':
-                        store.lyrics = [Lyric(os.path.join(music_path, f'lyrics/{lang.strip()}.azml')) for lang in
-                                       value.split(',') if lang]
-
-                    store.info.cover = (cover_mime, cover)
-
-                self.__musics.append(store)
+        for shard, text in self.__shards.items():
+            for music_id, (start, end) in _index_catalog(text).items():
+                self.__index[music_id] = shard, start, end
 
     def add(self, music: Music):
         self.__edits.append(Edit(Edit.ADD, music))
@@ -153,104 +417,100 @@ class Repository:
         #     if music_id in self.__musics:
         self.__edits.append(Edit(Edit.REMOVE, music_id))
 
-    def commit(self):
+    def commit(self, jobs: int = 1, cache: TranscodeCache = None, link_from: str = None):
+        """
+        提交修改。曲目、列表与头部先写入暂存区，全部完成后记入日志并移入仓库，头部最后移入。
+        中断的提交再次执行时，暂存区中已完成的音质不再重新生成；已记入日志的提交在下次打开仓库时完成移入。
+        link_from为可以硬链接到仓库的音频文件所在的目录，通常是Store的files目录，其他文件被复制
+        """
+        codec = get_codec(self.__headers.get('codec'), threads=jobs)  # Large lists are compressed in parallel
+        lyric_codec = self.lyric_codec
         # Music
         update_time = None
         if len(self.__edits):
+            staging = os.path.join(self.__path, STAGING_PATH)
+            os.makedirs(os.path.join(staging, 'music'), exist_ok=True)
+            os.makedirs(os.path.join(self.__path, 'cover'), exist_ok=True)  # Covers are shared and written in place
+
+            # Only the last addition of a song is kept
+            added: dict[str, Music] = {}
+            removed: set[str] = set()
+            for edit in self.__edits:
+                if edit.type == Edit.ADD:
+                    added[str(edit.data.info.id)] = edit.data
+                elif edit.type == Edit.REMOVE:
+                    added.pop(str(edit.data), None)
+                    removed.add(str(edit.data))
+
+            # Songs staged by an interrupted commit are reused if their audio is not changed since
+            stages = _read_journal(staging)[0]
+            with open(os.path.join(staging, JOURNAL_NAME), 'a') as journal:
+                for song_id, music in added.items():
+                    fingerprint = _fingerprint(music)
+                    if stages.get(song_id) != fingerprint:
+                        shutil.rmtree(os.path.join(staging, 'music', song_id), ignore_errors=True)
+                        journal.write(json.dumps({'stage': song_id, 'fingerprint': fingerprint}) + '\n')
+
+            # Results are collected in submission order, so the list stays deterministic
+            pending = list(added.values())
+            if jobs > 1 and len(pending) > 1:
+                for music in pending:
+                    music.info.cover  # Load lazy covers here, pickling happens in another thread
+                # Workers record their own spans and send them back with the results
+                func = partial(profiling.run_traced, _commit_music) if profiling.enabled() else _commit_music
+                with ProcessPoolExecutor(max_workers=min(jobs, len(pending))) as executor:
+                    results = list(executor.map(func, [self.__path] * len(pending), pending, [cache] * len(pending),
+                                                [lyric_codec] * len(pending), [staging] * len(pending),
+                                                [link_from] * len(pending)))
+                if profiling.enabled():
+                    for _, events in results:
+                        profiling.extend(events)
+                    results = [item for item, _ in results]
+            else:
+                results = [_commit_music(self.__path, music, cache, lyric_codec, staging, link_from)
+                           for music in pending]
+            if cache is not None:
+                with span('cache.evict'):
+                    cache.evict()
+
+            infos = dict(zip(added, results))
             new_items = []
-            old_music_count = len(self.__musics)
             for edit in self.__edits:
                 if edit.type == Edit.ADD:
-                    music = edit.data
-                    logging.debug(f'Processing Music {music.info.title}: {music.info.id}')
-                    music_path = os.path.join(self.__path, 'music/' + str(music.info.id))
-                    os.mkdir(music_path)
-                    os.mkdir(os.path.join(music_path, 'cover'))
-                    os.mkdir(os.path.join(music_path, 'files'))
-                    os.mkdir(os.path.join(music_path, 'lyrics'))
-                    tmp = {'id': music.info.id, 'title': music.info.title}
-                    if music.info.artist:
-                        tmp['artist'] = json.dumps(music.info.artist)
-                    if music.info.album:
-                        tmp['album'] = music.info.album
-                    if music.info.type is not None:
-                        tmp['type'] = str(music.info.type)
-                    if music.info.num is not None:
-                        tmp['num'] = str(music.info.num)
-                    if music.info.description:
-                        tmp['description'] = music.info.description
-                    if music.info.cover[1]:
-                        with open(os.path.join(music_path, 'cover/cover'), 'wb') as f:
-                            f.write(music.info.cover[1])
-                        tmp['cover'] = 'cover'
-                        tmp['cover_mime'] = music.info.cover[0]
-                    highest_quality = music.files.highest_quality()
-                    for quality in range(AudioFile.NORMAL, highest_quality + 1):
-                        if music.files.get_file_from_quality(quality) is None:
-                            if quality < highest_quality:
-                                output_path = os.path.join(music_path,
-                                                           f'files/{AudioFile.get_quality_str(quality)}.mp3')
-                                convert(
-                                    input_file=music.files.get_file_from_quality(highest_quality),
-                                    output_path=output_path,
-                                    quality=quality
-                                )
-                                file = open(output_path, 'rb')
-                                md5 = hashlib.md5(file.read()).hexdigest()
-                                file.close()
-                                with open(output_path + '.md5', 'w') as f:
-                                    f.write(md5)
-                        else:
-                            output_path = os.path.join(music_path,
-                                                       f'files/{AudioFile.get_quality_str(quality)}{os.path.splitext(music.files.get_file_from_quality(quality).path)[1]}')
-                            shutil.copyfile(
-                                music.files.get_file_from_quality(quality).path,
-                                output_path
-                            )
-                            file = open(output_path, 'rb')
-                            md5 = hashlib.md5(file.read()).hexdigest()
-                            file.close()
-                            with open(output_path + '.md5', 'w') as f:
-                                f.write(md5)
-                    tmp['quality'] = AudioFile.get_quality_str(highest_quality)
-
-                    # Lyrics
-                    languages = []
-                    for lyric in music.lyrics:
-                        lyric.export(os.path.join(music_path, f'lyrics/{lyric.lang}.azml'))
-                        languages.append(lyric.lang)
-                    tmp['lyriclang'] = ','.join(languages)
-                    new_items.append(tmp)
-
-                    self.__musics.append(music)
+                    if added.get(str(edit.data.info.id)) is edit.data and str(edit.data.info.id) in infos:
+                        new_items.append(infos.pop(str(edit.data.info.id)))
                 elif edit.type == Edit.REMOVE:
-                    shutil.rmtree(os.path.join(self.__path, 'music/' + str(edit.data)))
                     new_items.append({'remove': str(edit.data)})
 
             # Write to meta
             update_time = int(time.time() * 1000)
             self.__headers['list'] += ',' + str(update_time)
 
-            with lzma.open(os.path.join(self.__path, 'meta/list/all.xz'), 'r') as f:
-                data = f.read().decode('utf-8')
-            with lzma.open(os.path.join(self.__path, 'meta/list/all.xz'), 'w') as f:
-                if data:
-                    blocks = data.split('\n\n')
-                    if blocks[-1] == '':
-                        blocks.pop()
-                    removed_identities = ['id:' + str(item.data) for item in self.__edits if item.type == Edit.REMOVE]
-                    blocks = [block for block in blocks if block.split('\n')[0] not in removed_identities]
-                    data = '\n\n'.join(blocks).strip()
-                data += ('\n\n' + ('\n\n'.join(['\n'.join([f'{key}:{value}' for key, value in info.items()])
-                                                for info in new_items if 'remove' not in info])))
-                f.write(data.strip().encode('utf-8'))
-
-            with lzma.open(os.path.join(self.__path, f'meta/list/{update_time}.xz'), 'w') as f:
-                data = '\n\n'.join(['\n'.join([f'{key}:{value}' for key, value in info.items()])
-                                    for info in new_items]).strip()
-                f.write(data.encode('utf-8'))
+            with span('catalog'):
+                unused_covers = self.__update_catalog(new_items)
+            replace, remove = self.__write_catalog(staging, codec, jobs)
+
+            data = '\n\n'.join(['\n'.join([f'{key}:{value}' for key, value in info.items()])
+                                for info in new_items]).strip()
+            with span('compress', file=f'{update_time}.xz', codec=codec.name):
+                write_atomic(os.path.join(staging, f'meta/list/{update_time}.xz'), codec.compress(data.encode('utf-8')))
 
             self.__headers['last_update'] = str(update_time)
+            self.__write_header(staging)
+
+            # From here on the commit is finished by _finish_commit, even after being interrupted
+            replace = [f'music/{song_id}' for song_id in added] + replace + [f'meta/list/{update_time}.xz',
+                                                                            'meta/header.xz']
+            remove = [f'music/{song_id}' for song_id in removed - set(added)] + remove + unused_covers
+            with open(os.path.join(staging, JOURNAL_NAME), 'a') as journal:
+                journal.write(json.dumps({'commit': update_time, 'replace': replace, 'remove': remove}) + '\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+            with span('swap'):
+                _finish_commit(self.__path)
+            for song_id in removed:
+                self.__musics.pop(song_id, None)
+            self.__musics.update(added)
         else:  # No edits
             if not self.__header_edited:
                 raise RepositoryNotChangedException(self.__path)
@@ -260,18 +520,171 @@ class Repository:
             # with lzma.open(os.path.join(self.__path, f'meta/list/{update_time}.xz'), 'w') as f:
             #     f.write(b'')
 
-        # Headers
-        # if update_time is None:
-        #     update_time = int(time.time() * 1000)
-        header_text = '\n'.join([f'{key}:{value if value else ""}' for key, value in self.__headers.items()])
-        with lzma.open(os.path.join(self.__path, 'meta/header.xz'), 'w') as f:
-            f.write(header_text.encode('utf-8'))
+            # Headers
+            # if update_time is None:
+            #     update_time = int(time.time() * 1000)
+            self.__write_header()
 
         self.__edits = []
 
+    def __write_header(self, root: str = None):
+        """写入头部，root为暂存区时由_finish_commit移入仓库
+        """
+        header_text = '\n'.join([f'{key}:{value if value else ""}' for key, value in self.__headers.items()])
+        with span('compress', file='header.xz'):
+            write_atomic(os.path.join(root or self.__path, 'meta/header.xz'),
+                         self.codec.compress(header_text.encode('utf-8')))
+
+    @property
+    def delta_list(self) -> list[int]:
+        """增量列表的时间戳(毫秒)，从旧到新
+        """
+        return [int(name) for name in (self.__headers.get('list') or '').split(',') if name and name != 'all']
+
+    def __merge_deltas(self, timestamps: list[int]) -> tuple[dict[str, str], set[str]]:
+        """按顺序合并增量列表，返回({ID: 最后的曲目信息}, 被删除过的曲目ID)
+        """
+        added = {}
+        removed = set()
+        for timestamp in timestamps:
+            text = _read_compressed(os.path.join(self.__path, f'meta/list/{timestamp}.xz')).decode('utf-8').strip()
+            for block in text.split('\n\n'):
+                if block.startswith('remove:'):
+                    music_id = block[7:].strip()
+                    added.pop(music_id, None)
+                    removed.add(music_id)
+                elif block:
+                    match = re.search(r'^id:(.*)$', block, re.MULTILINE)
+                    if match:
+                        added[match.group(1).strip()] = block
+        return added, removed
+
+    def diff_since(self, timestamp: int) -> tuple[list[Music], list[UUID16]]:
+        """timestamp(毫秒)之后的净变化，返回(新增或修改的曲目, 删除的曲目ID)。
+        同一曲目的多次修改只返回最后一次，新增后又删除的曲目只出现在删除列表中
+        """
+        added, removed = self.__merge_deltas([name for name in self.delta_list if name > timestamp])
+        return [_parse_music(self.__path, block) for block in added.values()], \
+            [UUID16(music_id) for music_id in removed if music_id not in added]
+
+    def compact(self, keep: int = 10) -> int:
+        """将除最近keep个以外的增量列表合并为一个检查点，返回被合并的增量列表数。
+        检查点以合并的最后一个增量列表的时间戳命名，其内容是这些增量列表的净变化，
+        从其中任意一个增量列表之前的状态应用检查点都能得到相同的结果
+        """
+        timestamps = self.delta_list
+        merged = timestamps[:-keep] if keep > 0 else timestamps
+        if len(merged) < 2:
+            return 0
+        added, removed = self.__merge_deltas(merged)
+        # Every added song is removed first, like an edited song in the deltas written by commit, so players that
+        # already applied part of the merged deltas replace it instead of adding it twice. Unknown removes are ignored
+        blocks = [f'remove:{music_id}' for music_id in sorted(removed | set(added))] + list(added.values())
+        codec = self.codec
+        with span('compress', file=f'{merged[-1]}.xz', codec=codec.name):
+            write_atomic(os.path.join(self.__path, f'meta/list/{merged[-1]}.xz'),
+                         codec.compress('\n\n'.join(blocks).encode('utf-8')))
+        self.__headers['list'] = ','.join(['all'] + [str(timestamp) for timestamp in timestamps[len(merged) - 1:]])
+        self.__write_header()
+        for timestamp in merged[:-1]:  # Removed after the header no longer lists them
+            os.remove(os.path.join(self.__path, f'meta/list/{timestamp}.xz'))
+        return len(merged)
+
+    def __update_catalog(self, new_items: list[dict]) -> list[str]:
+        """从目录分片中删除被移除的曲目并加入新曲目，只修改涉及的分片。返回不再使用的封面文件
+        """
+        removed = {str(item.data) for item in self.__edits if item.type == Edit.REMOVE}
+        removed_blocks = []
+        for shard in {self.__index[music_id][0] for music_id in removed if music_id in self.__index}:
+            text = self.__shards[shard]
+            blocks = []
+            for music_id, (start, end) in _index_catalog(text).items():
+                (removed_blocks if music_id in removed else blocks).append(text[start:end])
+            self.__shards[shard] = '\n\n'.join(blocks)
+            self.__dirty_shards.add(shard)
+
+        # New songs fill the last shard, then new shards
+        shard = max(self.__shards, default=0)
+        count = len(_index_catalog(self.__shards.get(shard, '')))
+        for info in new_items:
+            if 'remove' in info:
+                continue
+            if count >= SHARD_SIZE:
+                shard, count = shard + 1, 0
+            block = '\n'.join([f'{key}:{value}' for key, value in info.items()])
+            self.__shards[shard] = (self.__shards.get(shard, '') + '\n\n' + block).strip()
+            self.__dirty_shards.add(shard)
+            count += 1
+
+        self.__index = {music_id: location for music_id, location in self.__index.items()
+                        if location[0] not in self.__dirty_shards}
+        for shard in self.__dirty_shards:
+            for music_id, (start, end) in _index_catalog(self.__shards.get(shard, '')).items():
+                self.__index[music_id] = shard, start, end
+
+        # Covers no longer used by any song, removed after the new lists are in place
+        unused = []
+        for block in removed_blocks:
+            for cover_hash in re.findall(r'^cover_hash:(.*)$', block, re.MULTILINE):
+                line = f'cover_hash:{cover_hash}'
+                if not any(line in text for text in self.__shards.values()):
+                    unused.extend(f'cover/{name}' for name in
+                                  [cover_hash] + [f'{cover_hash}@{size}' for size in THUMBNAIL_SIZES])
+        return unused
+
+    def __write_catalog(self, staging: str, codec: Codec, jobs: int = 1) -> tuple[list[str], list[str]]:
+        """将修改过的分片与分片索引写入暂存区，并拼接分片生成兼容旧播放器的all.xz。
+        返回(需要移入仓库的文件, 需要删除的文件)
+        """
+        catalog_path = os.path.join(self.__path, CATALOG_PATH)
+        staged_path = os.path.join(staging, CATALOG_PATH)
+        os.makedirs(catalog_path, exist_ok=True)
+        os.makedirs(staged_path, exist_ok=True)
+        replace, remove = [], []
+
+        def write_shard(shard: int):
+            with span('compress', file=f'catalog/{shard}.xz', codec=codec.name):
+                write_atomic(os.path.join(staged_path, f'{shard}.xz'),
+                             codec.compress(self.__shards[shard].encode('utf-8')))
+
+        for shard in sorted(self.__dirty_shards):
+            if not self.__shards.get(shard):  # Every song of the shard was removed
+                self.__shards.pop(shard, None)
+                remove.append(f'{CATALOG_PATH}/{shard}.xz')
+        dirty = sorted(self.__dirty_shards & set(self.__shards))
+        if jobs > 1 and len(dirty) > 1:  # lzma releases the GIL while compressing
+            with ThreadPoolExecutor(max_workers=min(jobs, len(dirty))) as executor:
+                list(executor.map(write_shard, dirty))
+        else:
+            for shard in dirty:
+                write_shard(shard)
+        replace.extend(f'{CATALOG_PATH}/{shard}.xz' for shard in dirty)
+        self.__dirty_shards = set()
+        shards = sorted(self.__shards)
+        write_atomic(os.path.join(staged_path, 'index'),
+                     ''.join(f'{shard}:{len(_index_catalog(self.__shards[shard]))}\n' for shard in shards).encode())
+        replace.append(f'{CATALOG_PATH}/index')
+
+        # A sequence of xz streams is decompressed as their concatenation
+        with span('catalog.concat', file='all.xz'):
+            streams = []
+            for shard in shards:
+                if streams:
+                    streams.append(SHARD_SEPARATOR)
+                with open(os.path.join(staged_path if shard in dirty else catalog_path, f'{shard}.xz'), 'rb') as f:
+                    streams.append(f.read())
+            write_atomic(os.path.join(staging, 'meta/list/all.xz'), b''.join(streams) or lzma.compress(b''))
+        replace.append('meta/list/all.xz')
+        return replace, remove
+
     def set_header(self, key: str, value: str):
         if key in HEADERS_PROTECTED:
             raise HeaderProtectedException(key)
+        if key in CODEC_HEADERS and value:
+            codec = get_codec(value)
+            if key == 'codec' and not isinstance(codec, XzCodec):  # Lists are .xz files read by every player
+                raise InvalidCodecException(value)
+            value = codec.name
         try:
             rewrite = self.get_header(key) != value
         except HeaderNotFoundException:
@@ -306,6 +719,18 @@ class Repository:
     def path(self):
         return self.__path
 
+    @property
+    def codec(self) -> Codec:
+        """头部、列表与目录分片的压缩格式，只能是xz
+        """
+        return get_codec(self.__headers.get('codec'))
+
+    @property
+    def lyric_codec(self) -> Codec:
+        """歌词的压缩格式，未设置时为xz
+        """
+        return get_codec(self.__headers.get('lyric_codec'))
+
     @staticmethod
     def create(path, repository_id: UUID16):
         path = os.path.abspath(path)
@@ -315,22 +740,49 @@ class Repository:
         os.mkdir(path)
         os.mkdir(os.path.join(path, 'meta'))
         os.mkdir(os.path.join(path, 'meta/list'))
+        os.mkdir(os.path.join(path, CATALOG_PATH))
+        write_atomic(os.path.join(path, CATALOG_PATH, 'index'), b'')
         os.mkdir(os.path.join(path, 'music'))
-        with lzma.open(os.path.join(path, 'meta/header.xz'), 'wb') as f:
-            f.write(f'id:{str(repository_id)}\n'
-                    f'last_update:0\n'
-                    f'version:{STORE_VERSION}\n'
-                    f'list:all\n'.encode('UTF-8'))
-        with lzma.open(os.path.join(path, 'meta/list/all.xz'), 'wb') as f:
-            f.write(''.encode('UTF-8'))
+        os.mkdir(os.path.join(path, 'cover'))
+        write_atomic(os.path.join(path, 'meta/header.xz'), get_codec().compress(
+            f'id:{str(repository_id)}\n'
+            f'last_update:0\n'
+            f'last_seq:0\n'
+            f'version:{STORE_VERSION}\n'
+            f'list:all\n'.encode('UTF-8')))
+        write_atomic(os.path.join(path, 'meta/list/all.xz'), get_codec().compress(b''))
         return Repository(path)
 
     @property
     def music_id_list(self):
-        return [item.info.id for item in self.__musics]
-
-
-def generate_repository_from_store(path: str, store: Store):
+        return [UUID16(music_id) for music_id in self.__index]
+
+    def get_music(self, music_id: UUID16) -> Music:
+        """读取仓库中的曲目，第一次访问时才解析
+        """
+        music_id = str(music_id)
+        if music_id not in self.__musics:
+            if music_id not in self.__index:
+                raise KeyError('No music with id {}'.format(music_id))
+            shard, start, end = self.__index[music_id]
+            self.__musics[music_id] = _parse_music(self.__path, self.__shards[shard][start:end])
+        return self.__musics[music_id]
+
+    def __contains__(self, music_id):
+        return str(music_id) in self.__index
+
+    def __len__(self):
+        return len(self.__index)
+
+
+def generate_repository_from_store(path: str, store: Store, jobs: int = 1, cache: TranscodeCache = None,
+                                   codec: str = None, lyric_codec: str = None):
+    """
+    发布Store中的变化到仓库。codec与lyric_codec为列表与歌词的压缩格式(见azuma.codec)，
+    指定时记录在仓库头部，之后的发布沿用头部记录的格式
+    """
+    if cache is None:
+        cache = TranscodeCache(os.path.join(store.path, 'cache'))
     if os.path.exists(path):
         repository = Repository(path)
         if repository.id != store.id:
@@ -345,23 +797,24 @@ def generate_repository_from_store(path: str, store: Store):
     repository.set_header('name', store.name)
     repository.set_header('maintainer', store.maintainer)
     repository.set_header('description', store.description)
-    edits_query = store.get_edit_log(int(repository.get_header('last_update')) / 1000)[::-1]
-    edits = []
-    removed = set()
-    for edit_type, uuid in edits_query:
-        if uuid in removed:
-            continue
-        if edit_type == 0:
-            edits.append((edit_type, uuid))
-        if edit_type == 1:
-            removed.add(uuid)
-            if uuid in repository.music_id_list:
-                edits.append((edit_type, uuid))
-    for edit_type, uuid in edits[::-1]:
-        if edit_type == 0:  # Add
-            music = store.get_music(uuid)
-            repository.add(music)
-        elif edit_type == 1:  # Delete
+    if codec:
+        repository.set_header('codec', codec)
+    if lyric_codec:
+        repository.set_header('lyric_codec', lyric_codec)
+    try:
+        since = int(repository.get_header('last_seq') or 0)
+    except HeaderNotFoundException:  # Repositories committed before edits had sequence numbers
+        since = store.last_seq(int(repository.get_header('last_update')) / 1000)
+    published = set(repository.music_id_list)
+    changes = store.get_changes(since)
+    for edit_type, uuid, _ in changes:
+        if edit_type == Edit.ADD:
+            if uuid in published:  # Edited after it was published
+                repository.remove(uuid)
+            repository.add(store.get_music(uuid))
+        elif uuid in published:
             repository.remove(uuid)
-    repository.commit()
+    if changes:
+        repository.set_header('last_seq', str(changes[-1][2]))
+    repository.commit(jobs=jobs, cache=cache, link_from=store.files_path)
     return repository
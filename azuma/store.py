@@ -9,41 +9,77 @@
 # (at your option) any later version.
 
 
-from sqlalchemy import Column, String, Integer, LargeBinary, JSON, create_engine, DateTime
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, String, Integer, LargeBinary, JSON, create_engine, DateTime, inspect, text, \
+    event, select, func
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import exists
 
-from azuma.exception import InvalidStoreException
+from azuma.exception import AzumaException, InvalidStoreException, StoreVersionIncompatibleException
+from azuma.fileio import digest_file, place_file
 from azuma.lyric import Lyric
 from azuma.music import Music
+from azuma.profiling import span
 from azuma.uuid import UUID16
 
 import datetime
 import os
-import copy
+import json
 import shutil
+from typing import Iterator
+import hashlib
+import sqlite3
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
 Base = declarative_base()
 
+SORT_KEYS = ['title', 'artist', 'album', 'num', 'time']
+AUDIO_EXTENSIONS = ['.mp3', '.flac']
+
 
 class MusicItem(Base):
     __tablename__ = 'music_item'
     id = Column(Integer, primary_key=True)  # Database field ID
-    song_id = Column(String(16))  # Song ID
+    song_id = Column(String(16), unique=True, index=True)  # Song ID
     title = Column(String)  # Name of song
     artist = Column(JSON, nullable=True)  # 艺术家
     album = Column(String, nullable=True)  # 专辑
-    cover_mime = Column(String, nullable=True)  # 专辑封面MIME
-    cover_content = Column(LargeBinary, nullable=True)  # 专辑封面内容
+    cover_hash = Column(String(64), nullable=True)  # 专辑封面SHA-256，对应Cover
     type = Column(String, nullable=True)  # 歌曲类型
     num = Column(Integer, nullable=True)  # 歌曲专辑内位置
     file = Column(JSON)  # 歌曲文件路径
+    file_info = Column(JSON, nullable=True)  # 歌曲文件大小、摘要与探测结果
     lyric = Column(JSON, nullable=True)  # 歌曲歌词
     description = Column(String, nullable=True)  # 备注
     time = Column(DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now)  # 添加时间
 
 
+class Cover(Base):
+    __tablename__ = 'cover'
+    hash = Column(String(64), primary_key=True)  # 封面内容SHA-256
+    mime = Column(String, nullable=True)  # 专辑封面MIME
+    content = Column(LargeBinary)  # 专辑封面内容
+
+
+class Content(Base):
+    __tablename__ = 'content'
+    sha256 = Column(String(64), primary_key=True)  # 文件内容SHA-256
+    path = Column(String)  # 仓库中内容相同的一个文件
+    mtime = Column(Integer)  # 写入时的修改时间(纳秒)，与文件不符时记录已失效
+    size = Column(Integer)
+
+
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer)  # 数据库结构版本，见MIGRATIONS
+
+
 class Config(Base):
     __tablename__ = 'config'
     id = Column(Integer, primary_key=True)
@@ -54,127 +90,667 @@ class Config(Base):
 
 class EditLog(Base):
     __tablename__ = 'editlog'
-    id = Column(Integer, primary_key=True)
+    __table_args__ = {'sqlite_autoincrement': True}  # Sequence numbers are never reused after compaction
+    seq = Column(Integer, primary_key=True)  # 编辑序号，单调递增
     type = Column(Integer)  # 0: add, 1: delete
-    uuid = Column(String(16))  # UUID
-    time = Column(DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now)  # 添加时间
+    uuid = Column(String(16), index=True)  # UUID
+    time = Column(DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now, index=True)  # 添加时间
+
+
+def _migrate_file_info(conn, path: str):
+    """1: 文件摘要与探测结果
+    """
+    columns = [column['name'] for column in inspect(conn).get_columns('music_item')]
+    if 'file_info' not in columns:
+        conn.execute(text('ALTER TABLE music_item ADD COLUMN file_info JSON'))
+
+
+def _migrate_cover(conn, path: str):
+    """2: 将封面移入按内容去重的cover表
+    """
+    Cover.__table__.create(conn, checkfirst=True)
+    columns = [column['name'] for column in inspect(conn).get_columns('music_item')]
+    if 'cover_hash' in columns:
+        return False
+    conn.execute(text('ALTER TABLE music_item ADD COLUMN cover_hash VARCHAR(64)'))
+    rows = conn.execute(text('SELECT id, cover_mime, cover_content FROM music_item '
+                             'WHERE cover_content IS NOT NULL'))
+    for row_id, mime, content in rows.fetchall():
+        cover_hash = hashlib.sha256(content).hexdigest()
+        conn.execute(text('INSERT OR IGNORE INTO cover (hash, mime, content) VALUES (:hash, :mime, :content)'),
+                     {'hash': cover_hash, 'mime': mime, 'content': content})
+        conn.execute(text('UPDATE music_item SET cover_hash = :hash WHERE id = :id'),
+                     {'hash': cover_hash, 'id': row_id})
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        conn.execute(text('ALTER TABLE music_item DROP COLUMN cover_content'))
+        conn.execute(text('ALTER TABLE music_item DROP COLUMN cover_mime'))
+    else:
+        conn.execute(text('UPDATE music_item SET cover_content = NULL'))
+    return True  # Give the space of the removed covers back
+
+
+def _migrate_index(conn, path: str):
+    """3: 曲目ID唯一索引及编辑记录索引
+    """
+    # Keep only the latest row of duplicated songs before adding the unique index
+    conn.execute(text('DELETE FROM music_item WHERE id NOT IN (SELECT max(id) FROM music_item GROUP BY song_id)'))
+    conn.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS ix_music_item_song_id ON music_item (song_id)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_editlog_uuid ON editlog (uuid)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_editlog_time ON editlog (time)'))
+
+
+def _migrate_song_directory(conn, path: str):
+    """4: 将files/<ID>_<音质>.<扩展名>移动到每首曲目单独的目录files/<ID>/<音质>.<扩展名>
+    """
+    files_path = os.path.join(os.path.dirname(path), 'files')
+    if not os.path.isdir(files_path):
+        return
+    names = {}
+    for name in os.listdir(files_path):
+        if os.path.isfile(os.path.join(files_path, name)) and '_' in name:
+            names.setdefault(name.split('_', 1)[0], []).append(name)
+    rows = conn.execute(text('SELECT id, song_id, file FROM music_item')).fetchall()
+    for row_id, song_id, file in rows:
+        file = json.loads(file) if isinstance(file, str) else file
+        song_path = os.path.join(files_path, song_id)
+        for name in names.pop(song_id, []):
+            os.makedirs(song_path, exist_ok=True)
+            new_name = name.split('_', 1)[1]
+            os.replace(os.path.join(files_path, name), os.path.join(song_path, new_name))
+            quality = os.path.splitext(new_name)[0]
+            if quality in file:
+                file[quality] = os.path.join(song_path, new_name)
+        conn.execute(text('UPDATE music_item SET file = :file WHERE id = :id'),
+                     {'file': json.dumps(file), 'id': row_id})
+    for song_names in names.values():  # Files of deleted songs
+        for name in song_names:
+            os.remove(os.path.join(files_path, name))
+
+
+def _fts_tokenizer() -> str:
+    # The trigram tokenizer also matches inside CJK text, which has no spaces between words
+    return 'trigram' if sqlite3.sqlite_version_info >= (3, 34, 0) else 'unicode61 remove_diacritics 2'
+
+
+def _fts_row(song_id: str, title, artist, album, description, lyric) -> dict:
+    return {
+        'song_id': song_id,
+        'title': title or '',
+        'artist': ' '.join(artist or []),
+        'album': album or '',
+        'description': description or '',
+        'lyric': '\n'.join(line['word'] for item in (lyric or []) for line in item['lyrics']),
+    }
+
+
+FTS_INSERT = text('INSERT INTO music_fts (song_id, title, artist, album, description, lyric) '
+                  'VALUES (:song_id, :title, :artist, :album, :description, :lyric)')
+
+
+def _migrate_fts(conn, path: str):
+    """5: 曲名、艺术家、专辑、备注与歌词的全文索引
+    """
+    conn.execute(text('CREATE VIRTUAL TABLE IF NOT EXISTS music_fts USING fts5('
+                      'song_id UNINDEXED, title, artist, album, description, lyric, '
+                      f"tokenize = '{_fts_tokenizer()}')"))
+    conn.execute(text('DELETE FROM music_fts'))
+    rows = conn.execute(text('SELECT song_id, title, artist, album, description, lyric FROM music_item'))
+    for song_id, title, artist, album, description, lyric in rows.fetchall():
+        artist = json.loads(artist) if isinstance(artist, str) else artist
+        lyric = json.loads(lyric) if isinstance(lyric, str) else lyric
+        conn.execute(FTS_INSERT, _fts_row(song_id, title, artist, album, description, lyric))
+
+
+def _migrate_edit_sequence(conn, path: str):
+    """6: 编辑记录使用单调递增的序号，删除旧记录后序号也不会重复
+    """
+    conn.execute(text('DROP INDEX IF EXISTS ix_editlog_uuid'))
+    conn.execute(text('DROP INDEX IF EXISTS ix_editlog_time'))
+    conn.execute(text('ALTER TABLE editlog RENAME TO editlog_old'))
+    EditLog.__table__.create(conn)
+    conn.execute(text('INSERT INTO editlog (seq, type, uuid, time) SELECT id, type, uuid, time FROM editlog_old '
+                      'ORDER BY id'))
+    conn.execute(text('DROP TABLE editlog_old'))
+
+
+def _migrate_content(conn, path: str):
+    """7: 按内容SHA-256索引仓库中的文件，用于去重
+    """
+    Content.__table__.create(conn, checkfirst=True)
+    rows = conn.execute(text('SELECT file, file_info FROM music_item WHERE file_info IS NOT NULL'))
+    for files, file_info in rows.fetchall():
+        files = json.loads(files) if isinstance(files, str) else files
+        file_info = json.loads(file_info) if isinstance(file_info, str) else file_info
+        for quality, info in file_info.items():
+            if (files or {}).get(quality) and info.get('sha256') and info.get('probe'):
+                conn.execute(text('INSERT OR REPLACE INTO content (sha256, path, mtime, size) '
+                                  'VALUES (:sha256, :path, :mtime, :size)'),
+                             {'sha256': info['sha256'], 'path': files[quality], 'mtime': info['probe']['mtime'],
+                              'size': info['probe']['size']})
+
+
+# MIGRATIONS[i] upgrades a database from schema version i to i + 1.
+# A migration returning True asks for a VACUUM afterwards.
+MIGRATIONS = [_migrate_file_info, _migrate_cover, _migrate_index, _migrate_song_directory, _migrate_fts,
+              _migrate_edit_sequence, _migrate_content]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+SQLITE_PRAGMAS = [
+    'PRAGMA journal_mode=WAL',  # Readers do not block the writer
+    'PRAGMA synchronous=NORMAL',  # Safe with WAL, avoids a sync on every commit
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-16000',  # 16 MiB page cache
+    'PRAGMA mmap_size=268435456',  # 256 MiB
+]
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+POOL_SIZE = 5  # Connections kept open, one per thread using the store
+POOL_MAX_OVERFLOW = 10
+BUSY_TIMEOUT = 30  # Seconds SQLite waits for a lock before raising "database is locked"
+BUSY_RETRIES = 5  # Retries of a transaction that failed on a lock
+BUSY_WAIT = 0.1  # Seconds before the first retry, doubled after every retry
+
+
+def _unchanged_path(entry: tuple[str, int, int]) -> str:
+    """entry为(路径, 修改时间, 大小)，文件存在且未被修改时返回路径
+    """
+    if entry is None:
+        return None
+    path, mtime, size = entry
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return path if stat.st_mtime_ns == mtime and stat.st_size == size else None
+
+
+def _is_busy(error: OperationalError) -> bool:
+    """数据库是否被其他连接锁定(SQLITE_BUSY)
+    """
+    return 'database is locked' in str(error.orig) or 'database is busy' in str(error.orig)
 
 
 class StoreDatabase:
+    """仓库数据库。每个线程使用独立的会话与连接，同一个StoreDatabase可在多个线程中使用。
+    每次操作都在一个较短的事务中完成，数据库被锁定时重试整个事务
+    """
+
     def __init__(self, path: str):
         self.__path = os.path.abspath(path)
-        if os.path.exists(self.__path):
-            self.__engine = create_engine('sqlite:///' + self.__path, echo=False)
+        exists_ = os.path.exists(self.__path)
+        self.__engine = create_engine('sqlite:///' + self.__path, echo=False, poolclass=QueuePool,
+                                      pool_size=POOL_SIZE, max_overflow=POOL_MAX_OVERFLOW,
+                                      connect_args={'check_same_thread': False, 'timeout': BUSY_TIMEOUT})
+        event.listen(self.__engine, 'connect', _set_sqlite_pragmas)
+        if exists_:
+            self.__upgrade()
         else:
-            self.__engine = create_engine('sqlite:///' + self.__path, echo=False)
             Base.metadata.create_all(self.__engine)
-        session = sessionmaker(bind=self.__engine)
-        self.__db_sess = session()
+            with self.__engine.begin() as conn:
+                _migrate_fts(conn, self.__path)
+                conn.execute(SchemaVersion.__table__.insert().values(version=SCHEMA_VERSION))
+        # Loaded objects stay usable after their transaction is committed
+        self.__db_sess = scoped_session(sessionmaker(bind=self.__engine, expire_on_commit=False))
+
+    def __upgrade(self):
+        """按顺序执行尚未执行的数据库迁移
+        """
+        SchemaVersion.__table__.create(self.__engine, checkfirst=True)
+        with self.__engine.begin() as conn:
+            row = conn.execute(select(SchemaVersion.version)).first()
+            version = row[0] if row else 0
+            if row is None:
+                conn.execute(SchemaVersion.__table__.insert().values(version=0))
+        if version > SCHEMA_VERSION:
+            raise StoreVersionIncompatibleException(self.__path, version)
+        vacuum = False
+        for migration in MIGRATIONS[version:]:
+            with self.__engine.begin() as conn:  # Each migration is applied atomically
+                vacuum = bool(migration(conn, self.__path)) or vacuum
+                version += 1
+                conn.execute(SchemaVersion.__table__.update().values(version=version))
+        if vacuum:
+            with self.__engine.connect() as conn:
+                conn.execute(text('VACUUM'))
+
+    def transaction(self, func, *args):
+        """在一个事务中执行func并提交，返回func的返回值。
+        数据库被其他连接锁定时回滚并重试，因此func只能包含数据库操作
+        """
+        for attempt in range(BUSY_RETRIES):
+            try:
+                result = func(*args)
+                self.__db_sess.commit()
+                return result
+            except OperationalError as e:
+                self.__db_sess.rollback()
+                if not _is_busy(e) or attempt == BUSY_RETRIES - 1:
+                    raise
+                logging.debug(f'Store database is locked, retry in {BUSY_WAIT * 2 ** attempt:.2f}s')
+                time.sleep(BUSY_WAIT * 2 ** attempt)
+            except BaseException:
+                self.__db_sess.rollback()
+                raise
+
+    def close(self):
+        """移除当前线程的会话，在线程池的线程中使用数据库后调用
+        """
+        self.__db_sess.remove()
 
     def new_item(self, item: MusicItem, auto_commit: bool = True):
-        self.__db_sess.add(item)
-        self.__db_sess.add(EditLog(type=0, uuid=str(item.song_id)))
+        def add():
+            self.__db_sess.add(item)
+            self.__db_sess.add(EditLog(type=0, uuid=str(item.song_id)))
+            self.__db_sess.execute(FTS_INSERT, _fts_row(str(item.song_id), item.title, item.artist, item.album,
+                                                        item.description, item.lyric))
         if auto_commit:
-            self.__db_sess.commit()
+            self.transaction(add)
+        else:
+            add()
 
     def get_item(self, *args):
-        return self.__db_sess.query(MusicItem).filter(*args).all()
+        return self.transaction(lambda: self.__db_sess.query(MusicItem).filter(*args).all())
+
+    def get_columns(self, columns, *args):
+        """只查询指定的列
+        """
+        return self.transaction(lambda: self.__db_sess.query(*columns).filter(*args).all())
+
+    def iter_columns(self, columns, *args, order_by=(), limit: int = None, offset: int = None,
+                     batch_size: int = 1000):
+        """只查询指定的列，并按批次从游标中读取结果。读取结束或生成器关闭时结束事务
+        """
+        query = self.__db_sess.query(*columns).filter(*args).order_by(*order_by)
+        if limit is not None:
+            query = query.limit(limit)
+        if offset:
+            query = query.offset(offset)
+        try:
+            yield from query.execution_options(stream_results=True).yield_per(batch_size)
+        finally:
+            self.__db_sess.commit()
+
+    def remove_item(self, song_id: UUID16, auto_commit: bool = True) -> set[str]:
+        """删除曲目，返回其引用的封面，曲目不存在时不做任何操作。自动提交时同时清理不再被引用的封面
+        """
+        def remove():
+            cover_hashes = {cover_hash for cover_hash, in self.__db_sess.query(MusicItem.cover_hash).filter(
+                MusicItem.song_id == str(song_id))}
+            if not self.__db_sess.query(MusicItem).filter(MusicItem.song_id == str(song_id)).delete():
+                return set()
+            self.__db_sess.add(EditLog(type=1, uuid=str(song_id)))
+            self.__db_sess.execute(text('DELETE FROM music_fts WHERE song_id = :song_id'),
+                                   {'song_id': str(song_id)})
+            if auto_commit:
+                self.prune_covers(cover_hashes)
+            return cover_hashes
+        return self.transaction(remove) if auto_commit else remove()
+
+    def search(self, query: str, limit: int = 20) -> list[tuple[str, str, list[str], float]]:
+        """全文搜索，返回按相关度排序的(曲目ID, 曲名, 艺术家, 得分)，得分越小越相关
+        """
+        terms = query.split()
+        if not terms:
+            return []
+        min_length = 3 if _fts_tokenizer() == 'trigram' else 1
+        # Terms the tokenizer cannot match are compared as substrings instead
+        match = ' '.join('"' + term.replace('"', '""') + '"' for term in terms if len(term) >= min_length)
+        criteria = []
+        params = {'limit': limit}
+        if match:
+            criteria.append('music_fts MATCH :match')
+            params['match'] = match
+        for i, term in enumerate(term for term in terms if len(term) < min_length):
+            criteria.append(f"(music_fts.title || ' ' || music_fts.artist || ' ' || music_fts.album || ' ' || "
+                            f"music_fts.description || ' ' || music_fts.lyric) LIKE :like{i} ESCAPE '\\'")
+            params[f'like{i}'] = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        rank = 'bm25(music_fts, 0, 10.0, 5.0, 3.0, 1.0, 0.5)' if match else '0'
+        rows = self.transaction(lambda: self.__db_sess.execute(text(
+            f'SELECT music_item.song_id, music_item.title, music_item.artist, {rank} AS score '
+            f'FROM music_fts JOIN music_item ON music_item.song_id = music_fts.song_id '
+            f'WHERE {" AND ".join(criteria)} ORDER BY score, music_item.title LIMIT :limit'), params).all())
+        return [(song_id, title, json.loads(artist) if isinstance(artist, str) else artist, score)
+                for song_id, title, artist, score in rows]
+
+    def prune_covers(self, cover_hashes):
+        """删除不再被任何曲目引用的封面，不提交
+        """
+        for cover_hash in cover_hashes:
+            if cover_hash is not None and not self.__db_sess.query(
+                    exists().where(MusicItem.cover_hash == cover_hash)).scalar():
+                self.__db_sess.query(Cover).filter(Cover.hash == cover_hash).delete()
+
+    def add_cover(self, cover_hash: str, mime: str, content: bytes, auto_commit: bool = True):
+        def add():
+            if self.__db_sess.get(Cover, cover_hash) is None:
+                self.__db_sess.add(Cover(hash=cover_hash, mime=mime, content=content))
+        if auto_commit:
+            self.transaction(add)
+        else:
+            add()
 
-    def remove_item(self, song_id: UUID16):
-        self.__db_sess.query(MusicItem).filter(MusicItem.song_id == str(song_id)).delete()
-        self.__db_sess.add(EditLog(type=1, uuid=str(song_id)))
-        self.__db_sess.commit()
+    def add_content(self, sha256: str, path: str, mtime: int, size: int, auto_commit: bool = True):
+        def add():
+            self.__db_sess.merge(Content(sha256=sha256, path=path, mtime=mtime, size=size))
+        if auto_commit:
+            self.transaction(add)
+        else:
+            add()
+
+    def find_content(self, sha256: str) -> tuple[str, int, int]:
+        """返回内容为sha256的文件的(路径, 修改时间, 大小)，没有时返回None
+        """
+        content = self.transaction(self.__db_sess.get, Content, sha256)
+        return None if content is None else (content.path, content.mtime, content.size)
+
+    def get_cover(self, cover_hash: str) -> tuple[str, bytes]:
+        cover = self.transaction(self.__db_sess.get, Cover, cover_hash)
+        if cover is None:
+            return None, None
+        return cover.mime, cover.content
 
     def get_edit_log(self, *args):
-        return self.__db_sess.query(EditLog).filter(*args).all()
+        return self.transaction(lambda: self.__db_sess.query(EditLog).filter(*args).all())
+
+    def get_changes(self, since: int = 0) -> list[tuple[int, str, int]]:
+        """返回序号since之后每首曲目的最后一次编辑(类型, 曲目ID, 序号)，按序号排序
+        """
+        # SQLite returns the other columns from the row holding max(seq)
+        rows = self.transaction(lambda: self.__db_sess.execute(text(
+            'SELECT type, uuid, max(seq) FROM editlog WHERE seq > :since GROUP BY uuid ORDER BY 3'),
+            {'since': since}).all())
+        return [(edit_type, uuid, seq) for edit_type, uuid, seq in rows]
+
+    def last_seq(self, until: datetime.datetime = None) -> int:
+        """最后一次编辑的序号，until不为空时只计算该时间及之前的编辑
+        """
+        query = self.__db_sess.query(func.max(EditLog.seq))
+        if until is not None:
+            query = query.filter(EditLog.time <= until)
+        return self.transaction(query.scalar) or 0
+
+    def compact_edit_log(self) -> int:
+        """删除已被同一曲目之后的编辑取代的记录，返回删除的条数
+        """
+        return self.transaction(lambda: self.__db_sess.execute(text(
+            'DELETE FROM editlog WHERE seq NOT IN (SELECT max(seq) FROM editlog GROUP BY uuid)')).rowcount)
+
+    def all_config(self) -> dict:
+        """一次查询读取全部配置项
+        """
+        config = {}
+        rows = self.transaction(lambda: self.__db_sess.query(Config.name, Config.value).order_by(Config.id).all())
+        for name, value in rows:
+            config.setdefault(name, value)
+        return config
 
     def __getitem__(self, item):
-        if self.__db_sess.query(exists().where(Config.name == item)).scalar():
-            value = self.__db_sess.query(Config).filter(Config.name == item).first().value
-            return value if value else None
-        else:
-            return None
+        config = self.transaction(lambda: self.__db_sess.query(Config.value).filter(Config.name == item).order_by(
+            Config.id).first())
+        return config[0] if config and config[0] else None
 
     def __setitem__(self, key, value):
-        if self.__db_sess.query(exists().where(Config.name == key)).scalar():
-            self.__db_sess.query(Config).filter(Config.name == key).first().value = value
-        else:
-            self.__db_sess.add(Config(name=key, value=value))
-        self.__db_sess.commit()
+        def set_config():
+            config = self.__db_sess.query(Config).filter(Config.name == key).order_by(Config.id).first()
+            if config is not None:
+                config.value = value
+            else:
+                self.__db_sess.add(Config(name=key, value=value))
+        self.transaction(set_config)
 
     def __delitem__(self, key):
-        self.__db_sess.query(Config).filter(Config.name == key).delete()
-        self.__db_sess.commit()
+        self.transaction(lambda: self.__db_sess.query(Config).filter(Config.name == key).delete())
+
+
+def _stat_info(path: str) -> dict:
+    stat = os.stat(path)
+    return {'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+class StoredMusic:
+    """仓库中的曲目，只包含ID与文件信息，通过load()从仓库读取完整的Music
+    """
+
+    def __init__(self, store: 'Store', song_id: UUID16, title: str, files: dict, file_info: dict,
+                 cover_hash: str = None):
+        self.__store = store
+        self.id = song_id  # 曲目ID
+        self.title = title  # 曲名
+        self.files = files  # 仓库中各音质的文件路径
+        self.file_info = file_info  # 各文件的摘要与探测结果
+        self.cover_hash = cover_hash  # 封面SHA-256
+
+    def __repr__(self):
+        return f'<StoredMusic {self.id}: {self.title}>'
+
+    def load(self) -> Music:
+        return self.__store.get_music(self.id)
 
 
 class Store:
     def __init__(self, path: str):
         self.__path = os.path.abspath(path)
+        self.__database = None
+        self.__settings = None
+        self.__lock = threading.RLock()  # Guards opening the database and loading the config
+        self.__contents = {}  # {SHA-256: (path, mtime, size)} of files placed by this process, not committed yet
         if os.path.exists(self.__path):
             if not os.path.exists(os.path.join(self.__path, 'store.db')):
                 raise InvalidStoreException(self.__path)
         else:
             os.mkdir(self.__path)
-        self.__db = StoreDatabase(os.path.join(self.__path, 'store.db'))
+            self.__load_config()  # A new store gets its ID and create time right away
         self.__files_path = os.path.join(self.__path, 'files/')
         if not os.path.exists(self.__files_path):
             os.mkdir(self.__files_path)
 
-        # ID
-        if self.__db['id'] is None:
-            self.__id = UUID16()
-            self.__db['id'] = str(self.__id)
-        else:
-            self.__id = UUID16(self.__db['id'])
-
-        # Create Time
-        if self.__db['create_time'] is None:
-            self.__create_time = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-            self.__db['create_time'] = self.__create_time
-        else:
-            self.__create_time = self.__db['create_time']
+    @property
+    def __db(self) -> StoreDatabase:
+        """数据库在第一次使用时才打开
+        """
+        if self.__database is None:
+            with self.__lock:
+                if self.__database is None:
+                    self.__database = StoreDatabase(os.path.join(self.__path, 'store.db'))
+        return self.__database
+
+    def __load_config(self) -> dict:
+        """第一次使用时一次性读取全部配置项
+        """
+        db = self.__db
+        with self.__lock:
+            if self.__settings is None:
+                settings = db.all_config()
+                # ID
+                if not settings.get('id'):
+                    settings['id'] = db['id'] = str(UUID16())
+                # Create Time
+                if not settings.get('create_time'):
+                    settings['create_time'] = db['create_time'] = \
+                        datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+                self.__settings = settings
+        return self.__settings
 
     @property
     def id(self):
-        return self.__id
+        return UUID16(self.__load_config()['id'])
 
-    def commit_music(self, music: Music):
-        store_music = copy.deepcopy(music)
+    @property
+    def path(self):
+        return self.__path
 
+    @property
+    def files_path(self):
+        """音乐文件所在的目录，其中的文件只会被替换，不会被原地修改
+        """
+        return self.__files_path
+
+    def __prepare_music(self, music: Music) -> StoredMusic:
+        """复制音乐文件到仓库并计算摘要，不访问数据库，可在线程池中执行。
+        不会复制或修改传入的Music
+        """
         # Generate ID when no ID
-        if music.info.id is None:
-            store_music.info.id = UUID16()
+        song_id = music.info.id if music.info.id is not None else UUID16()
 
-        # Copy all music files to store folder
+        # Copy all music files to the folder of the song
+        os.makedirs(self.__song_path(song_id), exist_ok=True)
+        files = {}
+        file_info = {}
         for quality, path in music.files.to_dict().items():
+            files[quality] = None
             if path:
-                new_path = os.path.join(self.__files_path,
-                                        str(store_music.info.id) + '_' + quality + os.path.splitext(path)[-1])
-                if path != new_path:
-                    shutil.copyfile(path, new_path)
-                    store_music.files.__dict__[quality].__path = new_path
+                file = music.files.__dict__[quality]
+                new_path = os.path.join(self.__song_path(song_id), quality + os.path.splitext(path)[-1])
+                with span('store.copy', song=song_id, tier=quality):
+                    if path != new_path:
+                        digests = self.__place_file(path, new_path, file.digests)
+                    elif not all(file.digests.get(name) for name in ('md5', 'sha256')):
+                        digests = digest_file(path, ('md5', 'sha256'))
+                    else:
+                        digests = file.digests
+                with span('store.probe', song=song_id, tier=quality):
+                    probe = dict(file.probe(), **_stat_info(new_path))
+                files[quality] = new_path
+                file_info[quality] = dict(digests, probe=probe)
+
+        # Covers are stored once per content
+        if music.info.cover_loaded:
+            content = music.info.cover[1]
+            cover_hash = hashlib.sha256(content).hexdigest() if content else None
+        else:
+            cover_hash = music.info.cover_hash
+        return StoredMusic(self, song_id, music.info.title, files, file_info, cover_hash)
 
+    def __add_music(self, music: Music, stored: StoredMusic):
+        """将准备好的曲目写入数据库会话，不提交
+        """
         # Delete if exists
-        query = self.__db.get_item(MusicItem.song_id == str(store_music.info.id))
-        if query:
-            self.__db.remove_item(store_music.info.id)
+        old_cover_hashes = self.__db.remove_item(stored.id, auto_commit=False)
+
+        if stored.cover_hash is not None and music.info.cover_loaded:
+            mime, content = music.info.cover
+            self.__db.add_cover(stored.cover_hash, mime, content, auto_commit=False)
 
         # Add to database
         self.__db.new_item(MusicItem(
-            song_id=str(store_music.info.id),
-            title=store_music.info.title,
-            artist=store_music.info.artist,
-            album=store_music.info.album,
-            cover_mime=store_music.info.cover[0],
-            cover_content=store_music.info.cover[1],
-            type=store_music.info.type,
-            num=store_music.info.num,
-            file=store_music.files.to_dict(),
-            lyric=[lyric.to_dict() for lyric in store_music.lyrics],
-            description=store_music.info.description
-        ))
-
-        return store_music
+            song_id=str(stored.id),
+            title=music.info.title,
+            artist=music.info.artist,
+            album=music.info.album,
+            cover_hash=stored.cover_hash,
+            type=music.info.type,
+            num=music.info.num,
+            file=stored.files,
+            file_info=stored.file_info,
+            lyric=[lyric.to_dict() for lyric in music.lyrics],
+            description=music.info.description
+        ), auto_commit=False)
+        for quality, path in stored.files.items():
+            info = stored.file_info.get(quality) or {}
+            if path and info.get('sha256'):
+                self.__db.add_content(info['sha256'], path, info['probe']['mtime'], info['probe']['size'],
+                                      auto_commit=False)
+        self.__db.prune_covers(old_cover_hashes)
+
+    def __find_content(self, sha256: str):
+        """查找仓库中内容相同的文件，返回其路径。文件已被修改或删除时返回None。
+        先查找本进程刚放入、可能还未写入数据库的文件，再查询content表
+        """
+        with self.__lock:
+            entry = self.__contents.get(sha256)
+        return _unchanged_path(entry) or _unchanged_path(self.__db.find_content(sha256))
+
+    def __place_file(self, src: str, dst: str, known: dict) -> dict:
+        """将音乐文件放入仓库，返回文件摘要。
+        仓库中已有相同内容的文件时链接到该文件，否则依次尝试reflink与复制
+        """
+        existing = self.__find_content(known['sha256']) if known.get('sha256') else None
+        if existing is not None and existing != dst:
+            digests = place_file(existing, dst, ('md5', 'sha256'), known=known, link=True)
+        else:
+            # Source files may be edited by their owner later, so they are never hardlinked
+            digests = place_file(src, dst, ('md5', 'sha256'), known=known)
+            existing = self.__find_content(digests['sha256'])
+            if existing is not None and existing != dst:
+                place_file(existing, dst, (), link=True)
+        stat = os.stat(dst)
+        with self.__lock:
+            self.__contents[digests['sha256']] = (dst, stat.st_mtime_ns, stat.st_size)
+        return digests
+
+    def __song_path(self, song_id) -> str:
+        return os.path.join(self.__files_path, str(song_id))
+
+    def commit_music(self, music: Music) -> StoredMusic:
+        """将曲目写入仓库，返回仓库中曲目的StoredMusic
+        """
+        stored = self.__prepare_music(music)
+        with span('store.db', song=stored.id):
+            self.__db.transaction(self.__add_music, music, stored)
+        # Remove files of qualities the song no longer has
+        used = {path for path in stored.files.values() if path}
+        for entry in os.scandir(self.__song_path(stored.id)):
+            if entry.path not in used:
+                os.remove(entry.path)
+        return stored
+
+    def import_many(self, paths: list[str], jobs: int = None) -> list['StoredMusic']:
+        """批量导入音乐文件，paths可包含目录，目录将被递归遍历。
+        标签读取与文件复制在线程池中并行执行，全部曲目在同一个事务中写入数据库。
+        无法导入的文件会被跳过，返回导入成功的曲目
+        """
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                for root, dirs, names in os.walk(path):
+                    dirs.sort()
+                    files.extend(os.path.join(root, name) for name in sorted(names)
+                                 if os.path.splitext(name)[1].lower() in AUDIO_EXTENSIONS)
+            else:
+                files.append(path)
+
+        def prepare(file_path):
+            music = None
+            try:
+                music = Music(file_path)
+                return music, self.__prepare_music(music)
+            except BaseException as e:
+                if music is not None:  # IDs of new songs are generated, the directory holds only this file
+                    shutil.rmtree(self.__song_path(music.info.id), ignore_errors=True)
+                if not isinstance(e, Exception):
+                    raise
+                logging.warning(f'Skip {file_path}: {e!r}')  # Any file that cannot be read, eg. malformed tags
+                return None
+            finally:
+                self.__db.close()  # Content lookups open a session in this worker thread
+
+        def add_all():
+            for music, stored in prepared:
+                self.__add_music(music, stored)
+
+        futures = []
+        prepared = []
+        try:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                futures = [executor.submit(prepare, file_path) for file_path in files]
+            prepared = [future.result() for future in futures if future.result() is not None]
+            with span('store.db', songs=len(prepared)):
+                self.__db.transaction(add_all)
+        except BaseException:
+            # Songs prepared by every worker are removed, including those finished after the failure
+            wait(futures)
+            for future in futures:
+                if future.done() and not future.cancelled() and future.exception() is None and future.result():
+                    shutil.rmtree(self.__song_path(future.result()[1].id), ignore_errors=True)
+            raise
+        return [stored for _, stored in prepared]
 
     def get_music(self, song_id) -> Music:
         tmp = Music()
@@ -184,11 +760,12 @@ class Store:
             tmp.info.title = query[0].title
             tmp.info.artist = query[0].artist
             tmp.info.album = query[0].album
-            tmp.info.cover = (query[0].cover_mime, query[0].cover_content)
+            if query[0].cover_hash is not None:
+                tmp.info.set_cover_loader(lambda h=query[0].cover_hash: self.__db.get_cover(h), query[0].cover_hash)
             tmp.info.type = query[0].type
             tmp.info.num = query[0].num
             tmp.info.description = query[0].description
-            tmp.files.from_dict(query[0].file)
+            tmp.files.from_dict(query[0].file, query[0].file_info)
             tmp.lyrics = [Lyric.from_dict(lyric) for lyric in query[0].lyric]
             return tmp
         else:
@@ -198,24 +775,69 @@ class Store:
         query = self.__db.get_item(MusicItem.song_id == str(song_id))
         if query:
             self.__db.remove_item(song_id)
-            for name in os.listdir(self.__files_path):
-                if name.startswith(str(song_id)):
-                    os.remove(os.path.join(self.__files_path, name))
+            for path in query[0].file.values():
+                if path and os.path.dirname(path) == self.__song_path(song_id) and os.path.exists(path):
+                    os.remove(path)
+            if os.path.isdir(self.__song_path(song_id)):
+                shutil.rmtree(self.__song_path(song_id))
         else:
             raise KeyError('No music with id {}'.format(song_id))
 
-    def all_items(self) -> list[tuple[UUID16, str, str]]:
-        query = self.__db.get_item()
-        return [(UUID16(item.song_id), item.title, item.artist) for item in query]
+    def search(self, query: str, limit: int = 20) -> list[tuple[UUID16, str, list[str]]]:
+        """在曲名、艺术家、专辑、备注与歌词中搜索，返回按相关度排序的(ID, 曲名, 艺术家)
+        """
+        return [(UUID16(song_id), title, artist) for song_id, title, artist, _ in self.__db.search(query, limit)]
+
+    def verify_music(self, song_id) -> dict[str, bool]:
+        """校验曲目文件的MD5，返回{音质: 是否完好}
+        """
+        query = self.__db.get_item(MusicItem.song_id == str(song_id))
+        if not query:
+            raise KeyError('No music with id {}'.format(song_id))
+        result = {}
+        for quality, path in query[0].file.items():
+            if path:
+                md5 = ((query[0].file_info or {}).get(quality) or {}).get('md5')
+                result[quality] = os.path.exists(path) and (md5 is None or digest_file(path)['md5'] == md5)
+        return result
+
+    def all_items(self, limit: int = None, offset: int = 0, sort: str = None, reverse: bool = False,
+                  title: str = None, artist: str = None, album: str = None) -> Iterator[tuple[UUID16, str, list[str]]]:
+        """逐条返回曲目的(ID, 曲名, 艺术家)，不会一次性载入全部曲目。
+        sort为排序字段(title, artist, album, num, time)，title、artist和album按包含关系过滤
+        """
+        if sort is None:
+            order_by = [MusicItem.id]
+        elif sort in SORT_KEYS:
+            order_by = [getattr(MusicItem, sort), MusicItem.id]
+        else:
+            raise ValueError(f'{sort} is not a valid sort key')
+        if reverse:
+            order_by = [column.desc() for column in order_by]
+        criteria = []
+        if title is not None:
+            criteria.append(MusicItem.title.contains(title, autoescape=True))
+        if artist is not None:
+            # Matched against each name, the JSON text is ASCII escaped
+            artists = func.json_each(MusicItem.artist).table_valued('value')
+            criteria.append(select(artists.c.value).where(artists.c.value.contains(artist, autoescape=True)).exists())
+        if album is not None:
+            criteria.append(MusicItem.album.contains(album, autoescape=True))
+        query = self.__db.iter_columns((MusicItem.song_id, MusicItem.title, MusicItem.artist), *criteria,
+                                       order_by=order_by, limit=limit, offset=offset)
+        for song_id, title_, artist_ in query:
+            yield UUID16(song_id), title_, artist_
 
     def config(self, key, value=None):
         if value is None:
-            return self.__db[key]
+            return self.__load_config().get(key) or None
         else:
             self.__db[key] = value
+            self.__load_config()[key] = value
 
     def unset(self, key):
         del self.__db[key]
+        self.__load_config().pop(key, None)
 
     @property
     def name(self):
@@ -244,3 +866,19 @@ class Store:
     def get_edit_log(self, timestamp: float = 0) -> list[tuple[int, UUID16]]:
         query = self.__db.get_edit_log(EditLog.time > datetime.datetime.fromtimestamp(timestamp))
         return [(item.type, UUID16(item.uuid)) for item in query]
+
+    def get_changes(self, since: int = 0) -> list[tuple[int, UUID16, int]]:
+        """编辑序号since之后的净变化，每首曲目只返回最后一次编辑(类型, ID, 序号)
+        """
+        return [(edit_type, UUID16(uuid), seq) for edit_type, uuid, seq in self.__db.get_changes(since)]
+
+    def last_seq(self, timestamp: float = None) -> int:
+        """最后一次编辑的序号，timestamp不为空时返回该时间之前最后一次编辑的序号
+        """
+        return self.__db.last_seq(None if timestamp is None else datetime.datetime.fromtimestamp(timestamp))
+
+    def compact(self) -> int:
+        """清理已被之后的编辑取代的编辑记录，返回删除的条数。
+        不影响增量提交，每首曲目的最后一次编辑都会保留
+        """
+        return self.__db.compact_edit_log()
@@ -0,0 +1,125 @@
+# Azuma Python Module https://azuma.sorasky.in/
+# Copyright (C) 2022  Sora
+# ALL RIGHTS RESERVED.
+#
+# The module is a part of Azuma Repository Manager Module.
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+"""压缩格式的大小与耗时比较
+
+    python benchmarks/codec.py [--songs 曲目数] [--lyrics 歌词数] [--codecs xz,xz:9e,...] [-j 线程数]
+
+生成与仓库相同格式的合成目录(catalog)与歌词(.azml)，对每种格式测量：
+
+    size            压缩后的总大小(字节)
+    ratio           压缩率
+    compress        压缩耗时(秒)，取中位数
+    decompress      解压耗时(秒)，取中位数
+
+目录作为一个整体压缩，-j大于1时xz使用多线程；歌词逐个压缩，与仓库中每首曲目一个文件相同。
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from azuma.codec import get_codec, decompress  # noqa: E402
+from azuma.file import AudioFile  # noqa: E402
+from azuma.uuid import UUID16, byte  # noqa: E402
+
+DEFAULT_CODECS = 'xz,xz:0,xz:9,xz:9e,zlib:9,zlib:9:azml1'
+WORDS = ['ame', 'sora', 'hoshi', 'kaze', 'yume', 'hikari', 'umi', 'tsuki', 'hana', 'koe', 'kimi', 'boku']
+
+
+def make_catalog(songs: int, rand: random.Random) -> bytes:
+    blocks = []
+    for index in range(songs):
+        blocks.append('\n'.join([
+            f'id:{UUID16("".join(rand.choices(byte, k=16)))}',  # Seeded, the same catalog for every run
+            f'title:{" ".join(rand.choices(WORDS, k=3))}',
+            f'artist:{json.dumps([f"Artist {index % 97}"])}',
+            f'album:Album {index % 503}',
+            f'num:{index % 12 + 1}',
+            f'cover_hash:{rand.getrandbits(256):064x}',
+            'cover_mime:image/jpeg',
+            'cover_sizes:128,512',
+            f'quality:{AudioFile.get_quality_str(rand.randint(AudioFile.NORMAL, AudioFile.ORIGINAL))}',
+            'lyriclang:ja,zh-CN',
+        ]))
+    return '\n\n'.join(blocks).encode('utf-8')
+
+
+def make_lyric(rand: random.Random) -> bytes:
+    lines = rand.randint(20, 60)
+    return json.dumps({
+        'artist': None, 'creator': None, 'offset': 0, 'orig': True, 'lang': 'ja', 'version': 1,
+        'lyrics': [{'time': f'{second // 60:02d}:{second % 60:02d}.{rand.randint(0, 99):02d}',
+                    'word': ' '.join(rand.choices(WORDS, k=rand.randint(3, 8)))}
+                   for second in sorted(rand.sample(range(300), lines))]
+    }).encode()
+
+
+def measure(func, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def run(name: str, items: list[bytes], spec: str, threads: int, repeat: int) -> dict:
+    codec = get_codec(spec, threads=threads)
+    compressed = [codec.compress(item) for item in items]
+    assert [decompress(item) for item in compressed] == items
+    original = sum(len(item) for item in items)
+    size = sum(len(item) for item in compressed)
+    return {
+        'data': name,
+        'codec': codec.name,
+        'size': size,
+        'ratio': size / original if original else 0,
+        'compress': measure(lambda: [codec.compress(item) for item in items], repeat),
+        'decompress': measure(lambda: [decompress(item) for item in compressed], repeat),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the size and time of Azuma codecs')
+    parser.add_argument('--songs', type=int, default=20000, help='number of songs in the synthetic catalog')
+    parser.add_argument('--lyrics', type=int, default=500, help='number of synthetic lyric files')
+    parser.add_argument('--codecs', type=str, default=DEFAULT_CODECS, help='comma separated codecs to compare')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='threads used by xz for the catalog')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each measurement, the median is reported')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('--json', action='store_true', help='output results as JSON')
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    catalog = [make_catalog(args.songs, rand)]
+    lyrics = [make_lyric(rand) for _ in range(args.lyrics)]
+    results = []
+    for spec in args.codecs.split(','):
+        results.append(run('catalog', catalog, spec, args.jobs, args.repeat))
+        results.append(run('lyrics', lyrics, spec, 1, args.repeat))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f'{"data":<10}{"codec":<16}{"size":>12}{"ratio":>9}{"compress":>12}{"decompress":>12}')
+    for item in results:
+        print(f'{item["data"]:<10}{item["codec"]:<16}{item["size"]:>12}{item["ratio"]:>9.3f}'
+              f'{item["compress"]:>12.4f}{item["decompress"]:>12.4f}')
+
+
+if __name__ == '__main__':
+    main()
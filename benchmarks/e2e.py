@@ -0,0 +1,228 @@
+# Azuma Python Module https://azuma.sorasky.in/
+# Copyright (C) 2022  Sora
+# ALL RIGHTS RESERVED.
+#
+# The module is a part of Azuma Repository Manager Module.
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+"""端到端性能测试
+
+    python benchmarks/e2e.py [--songs 曲目数] [--output 结果.json] [--baseline 基准.json]
+
+在临时目录中生成正弦波MP3/FLAC母带、封面与LRC歌词组成的仓库，测量以下操作的耗时(秒)：
+
+    commit_music            Store.commit_music，每首平均
+    all_items               遍历Store.all_items
+    get_music               Store.get_music，每首平均
+    publish_first           generate_repository_from_store，首次发布
+    publish_incremental     修改部分曲目后再次发布
+    repository_load         Repository(path)
+
+结果以JSON输出。指定--baseline时与保存的结果比较，变慢超过--threshold时以非零状态退出。
+需要ffmpeg，封面由Pillow生成，未安装时使用内置的PNG。
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import random
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import azuma  # noqa: E402
+from azuma import Store, Music, Lyric, Repository, generate_repository_from_store  # noqa: E402
+
+# 1x1 PNG, used as cover when Pillow is not installed
+FALLBACK_COVER = bytes.fromhex('89504e470d0a1a0a0000000d4948445200000001000000010802000000907753de0000000c4944415408d763'
+                               'f8cfc0000003010100c9fe92ef0000000049454e44ae426082')
+
+
+def make_cover(index: int) -> tuple[str, bytes]:
+    try:
+        from PIL import Image
+    except ImportError:
+        return 'image/png', FALLBACK_COVER
+    output = io.BytesIO()
+    color = ((index * 53) % 256, (index * 97) % 256, (index * 193) % 256)
+    Image.new('RGB', (600, 600), color).save(output, 'JPEG')
+    return 'image/jpeg', output.getvalue()
+
+
+def make_lrc(path: str, index: int, duration: float):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f'[ar:Artist {index % 7}]\n[by:Benchmark]\n')
+        for second in range(int(duration)):
+            f.write(f'[00:{second:02d}.00]line {second} of song {index}\n')
+
+
+def make_master(path: str, index: int, flac: bool, duration: float, covers: int):
+    """生成带标签与封面的正弦波母带
+    """
+    from pydub.generators import Sine
+    from mutagen.id3 import ID3, APIC, TIT2, TPE1, TALB, TRCK
+    from mutagen.flac import FLAC, Picture
+
+    tone = Sine(220 + 10 * index).to_audio_segment(duration=int(duration * 1000), volume=-6)
+    mime, cover = make_cover(index % covers)  # Songs of an album share a cover
+    title, artist, album = f'Song {index}', [f'Artist {index % 7}'], f'Album {index % covers}'
+    if flac:
+        tone.export(path, format='flac')
+        tags = FLAC(path)
+        tags['title'], tags['artist'], tags['album'], tags['tracknumber'] = title, artist, album, str(index + 1)
+        picture = Picture()
+        picture.data, picture.mime, picture.type = cover, mime, 3
+        tags.add_picture(picture)
+        tags.save()
+    else:
+        tone.export(path, format='mp3', bitrate='320k')
+        tags = ID3()
+        tags.add(TIT2(encoding=3, text=title))
+        tags.add(TPE1(encoding=3, text=artist))
+        tags.add(TALB(encoding=3, text=album))
+        tags.add(TRCK(encoding=3, text=str(index + 1)))
+        tags.add(APIC(encoding=3, mime=mime, type=3, desc='cover', data=cover))
+        tags.save(path)
+
+
+def make_fixtures(path: str, songs: int, flac_ratio: float, duration: float, seed: int) -> list[tuple[str, str]]:
+    """生成母带与歌词，返回[(母带路径, 歌词路径)]
+    """
+    os.makedirs(path, exist_ok=True)
+    rand = random.Random(seed)
+    fixtures = []
+    for index in range(songs):
+        flac = rand.random() < flac_ratio
+        master = os.path.join(path, f'{index}.flac' if flac else f'{index}.mp3')
+        lrc = os.path.join(path, f'{index}.lrc')
+        if not os.path.exists(master):
+            make_master(master, index, flac, duration, max(1, songs // 10))
+            make_lrc(lrc, index, duration)
+        fixtures.append((master, lrc))
+    return fixtures
+
+
+def timed(func, *args, **kwargs) -> tuple[float, object]:
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def median(func, repeat: int) -> float:
+    return statistics.median(timed(func)[0] for _ in range(repeat))
+
+
+def run(work: str, fixtures: list[tuple[str, str]], repeat: int, jobs: int, changed: float) -> dict:
+    store_path = os.path.join(work, 'store')
+    repository_path = os.path.join(work, 'repository')
+    store = Store(store_path)
+    result = {}
+
+    # Store.commit_music
+    ids = []
+    total = 0
+    for master, lrc in fixtures:
+        music = Music(master)
+        music.lyrics.append(Lyric.load_from_lrc(lrc, True, 'en'))
+        seconds, _ = timed(store.commit_music, music)
+        total += seconds
+        ids.append(music.info.id)
+    result['commit_music'] = total / len(fixtures)
+
+    result['all_items'] = median(lambda: sum(1 for _ in store.all_items()), repeat)
+    result['get_music'] = median(lambda: [store.get_music(song_id) for song_id in ids], repeat) / len(ids)
+
+    # Publishing, with a transcode cache of this run only
+    cache = azuma.TranscodeCache(os.path.join(work, 'cache'))
+    result['publish_first'], _ = timed(generate_repository_from_store, repository_path, store, jobs=jobs, cache=cache)
+    for song_id in ids[:max(1, int(len(ids) * changed))]:
+        music = store.get_music(song_id)
+        music.info.title += ' (edited)'
+        store.commit_music(music)
+    result['publish_incremental'], _ = timed(generate_repository_from_store, repository_path, store, jobs=jobs,
+                                             cache=cache)
+
+    result['repository_load'] = median(lambda: Repository(repository_path), repeat)
+    return result
+
+
+def compare(result: dict, baseline: dict, threshold: float) -> bool:
+    """打印与基准的比较，返回是否有操作变慢超过threshold
+    """
+    regressed = False
+    print(f'{"operation":<22}{"baseline":>12}{"current":>12}{"change":>10}', file=sys.stderr)
+    for name, seconds in result['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            print(f'{name:<22}{"-":>12}{seconds:>12.4f}{"-":>10}', file=sys.stderr)
+            continue
+        change = seconds / base - 1 if base else 0
+        mark = ' !' if change > threshold else ''
+        regressed = regressed or change > threshold
+        print(f'{name:<22}{base:>12.4f}{seconds:>12.4f}{change:>+10.1%}{mark}', file=sys.stderr)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of Azuma stores and repositories')
+    parser.add_argument('--songs', type=int, default=50, help='number of songs in the synthetic store')
+    parser.add_argument('--flac-ratio', type=float, default=0.5, help='share of songs with FLAC masters')
+    parser.add_argument('--duration', type=float, default=5, help='length of each song in seconds')
+    parser.add_argument('--changed', type=float, default=0.1, help='share of songs edited before the second publish')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each read benchmark, the median is reported')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of workers used to publish')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic store')
+    parser.add_argument('--fixtures', type=str, help='directory to keep generated masters in between runs')
+    parser.add_argument('--output', type=str, help='write results to this file instead of stdout')
+    parser.add_argument('--baseline', type=str, help='results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown ratio counted as a regression')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    work = tempfile.mkdtemp(prefix='azuma-bench-')
+    try:
+        fixtures = make_fixtures(args.fixtures or os.path.join(work, 'fixtures'), args.songs, args.flac_ratio,
+                                 args.duration, args.seed)
+        results = run(work, fixtures, args.repeat, args.jobs, args.changed)
+    finally:
+        shutil.rmtree(work)
+
+    output = {
+        'meta': {
+            'azuma': azuma.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': int(time.time()),
+            'songs': args.songs,
+            'flac_ratio': args.flac_ratio,
+            'duration': args.duration,
+            'jobs': args.jobs,
+        },
+        'results': results,
+    }
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(output, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# Azuma Python Module https://azuma.sorasky.in/
+# Copyright (C) 2022  Sora
+# ALL RIGHTS RESERVED.
+#
+# The module is a part of Azuma Repository Manager Module.
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+"""CLI启动时间测试
+
+    python benchmarks/startup.py [-n 次数] [--budget 毫秒]
+
+分别测量`azuma version`与在空仓库中执行`azuma list`的耗时中位数，
+并检查`import azuma`及`azuma version`不会载入SQLAlchemy、pydub与mutagen。
+超过预算或载入了重型依赖时以非零状态退出。
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ['sqlalchemy', 'pydub', 'mutagen']
+
+CHECK_IMPORTS = f'''
+import sys
+import json
+import azuma
+from azuma.cli import main
+main(['version'])
+print(json.dumps([name for name in {HEAVY_MODULES!r} if name in sys.modules]))
+'''
+
+
+def run(args, cwd=None) -> float:
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-m', 'azuma', *args], cwd=cwd, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return (time.perf_counter() - start) * 1000
+
+
+def measure(args, times: int, cwd=None) -> float:
+    run(args, cwd)  # Warm up the file system cache and the bytecode
+    return statistics.median(run(args, cwd) for _ in range(times))
+
+
+def baseline(times: int) -> float:
+    """Python解释器自身的启动时间
+    """
+    def run_python():
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        return (time.perf_counter() - start) * 1000
+    run_python()
+    return statistics.median(run_python() for _ in range(times))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure startup time of the Azuma CLI')
+    parser.add_argument('-n', '--times', type=int, default=20, help='number of runs of each command')
+    parser.add_argument('--budget', type=float, default=100, help='max milliseconds of `azuma version`')
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    output = subprocess.run([sys.executable, '-c', CHECK_IMPORTS], env=env, check=True, capture_output=True,
+                            text=True).stdout.splitlines()
+    loaded = json.loads(output[-1])
+
+    store_path = tempfile.mkdtemp()
+    try:
+        run(['create', os.path.join(store_path, 'store')])
+        result = {
+            'python': baseline(args.times),
+            'version': measure(['version'], args.times),
+            'list': measure(['list'], args.times, cwd=os.path.join(store_path, 'store')),
+            'heavy_modules_loaded': loaded,
+        }
+    finally:
+        shutil.rmtree(store_path)
+    print(json.dumps(result, indent=2))
+
+    if loaded:
+        print(f'`azuma version` imported {", ".join(loaded)}', file=sys.stderr)
+        sys.exit(1)
+    if result['version'] > args.budget:
+        print(f'`azuma version` took {result["version"]:.1f} ms, budget is {args.budget:.1f} ms', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+# Azuma Python Module https://azuma.sorasky.in/
+# Copyright (C) 2022  Sora
+# ALL RIGHTS RESERVED.
+#
+# The module is a part of Azuma Repository Manager Module.
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+"""仓库提交的中断与恢复
+
+    python -m unittest discover tests
+
+转码由convert_many的替身完成，母带只有STREAMINFO和随机数据，不需要ffmpeg。
+"""
+
+import os
+import sys
+import shutil
+import struct
+import tempfile
+import unittest
+import warnings
+
+from mutagen.flac import FLAC
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from azuma import Store, Music, Repository, TranscodeCache, generate_repository_from_store  # noqa: E402
+from azuma.audio import get_encoder_settings  # noqa: E402
+from azuma.file import AudioFile  # noqa: E402
+from azuma import repository  # noqa: E402
+
+
+def make_master(path: str, title: str):
+    """生成最小的FLAC母带：0.5秒44.1kHz立体声，随机数据使码率高于320kbps，所以是原始音质
+    """
+    sample_rate, channels, bits, samples = 44100, 2, 16, 22050
+    stream_info = struct.pack('>HH', 4096, 4096) + bytes(6)  # Block sizes, unknown frame sizes
+    stream_info += ((sample_rate << 44) | ((channels - 1) << 41) | ((bits - 1) << 36) | samples).to_bytes(8, 'big')
+    stream_info += bytes(16)  # MD5 of the samples, unknown
+    with open(path, 'wb') as f:
+        f.write(b'fLaC' + bytes([0x80]) + len(stream_info).to_bytes(3, 'big') + stream_info)
+        f.write(os.urandom(64 * 1024))  # Frames are never decoded, the fake convert_many only reads the path
+    tags = FLAC(path)
+    tags['title'], tags['artist'], tags['album'] = title, ['Azuma'], 'Tests'
+    tags.save()
+
+
+def fake_convert_many(input_file: AudioFile, outputs: dict[int, str]) -> dict:
+    for quality, output_path in outputs.items():
+        with open(output_path, 'wb') as f:
+            f.write(f'{input_file.path}:{quality}'.encode())
+    return {}
+
+
+class Interrupt(BaseException):
+    """代替Ctrl-C中断提交
+    """
+
+
+class RepositoryCommitTest(unittest.TestCase):
+    def setUp(self):
+        warnings.filterwarnings('ignore')
+        self.work = tempfile.mkdtemp(prefix='azuma-test-')
+        self.store = Store(os.path.join(self.work, 'store'))
+        self.ids = []
+        for index in range(2):
+            master = os.path.join(self.work, f'{index}.flac')
+            make_master(master, f'Song {index}')
+            music = Music(master)
+            self.store.commit_music(music)
+            self.ids.append(music.info.id)
+        self.path = os.path.join(self.work, 'repository')
+        self.conversions = []
+        self.fail_at = None
+        self.convert_many = repository.convert_many
+        repository.convert_many = self.convert
+
+    def tearDown(self):
+        repository.convert_many = self.convert_many
+        shutil.rmtree(self.work)
+
+    def convert(self, input_file, outputs):
+        self.conversions.append(sorted(outputs))
+        if len(self.conversions) == self.fail_at:
+            raise Interrupt
+        return fake_convert_many(input_file, outputs)
+
+    def commit(self, repo: Repository = None, cache: TranscodeCache = None) -> Repository:
+        if repo is None:  # Empty repositories are falsy
+            repo = Repository(self.path)
+        for song_id in self.ids:
+            repo.add(self.store.get_music(song_id))
+        repo.commit(cache=cache)
+        return repo
+
+    def assertComplete(self):
+        repo = Repository(self.path)
+        self.assertFalse(os.path.exists(os.path.join(self.path, repository.STAGING_PATH)))
+        self.assertEqual(sorted(map(str, repo.music_id_list)), sorted(map(str, self.ids)))
+        for song_id in self.ids:
+            files_path = os.path.join(self.path, 'music', str(song_id), 'files')
+            names = [name for name in os.listdir(files_path) if not name.endswith('.md5')]
+            self.assertEqual(len(names), AudioFile.ORIGINAL - AudioFile.NORMAL + 1)
+            for name in names:
+                self.assertTrue(repository._verified(os.path.join(files_path, name)), name)
+
+    def test_resume_skips_verified_tiers(self):
+        Repository.create(self.path, self.store.id)
+        self.fail_at = 2
+        with self.assertRaises(Interrupt):
+            self.commit()
+        self.assertEqual(os.listdir(os.path.join(self.path, 'music')), [])
+
+        self.conversions, self.fail_at = [], None
+        self.commit()
+        # The first song was finished before the interruption, only the second is converted
+        self.assertEqual([outputs for outputs in self.conversions if outputs], [[0, 1, 2, 3]])
+        self.assertComplete()
+
+    def test_resume_after_cache_hit(self):
+        """缓存命中的音质已链接到暂存区，但另一音质转码时被中断，还没有写入.md5
+        """
+        cache = TranscodeCache(os.path.join(self.work, 'cache'))
+        self.commit(Repository.create(os.path.join(self.work, 'warm'), self.store.id), cache)
+        source = self.store.get_music(self.ids[0]).files.get_file_from_quality(AudioFile.ORIGINAL)
+        source_hash = source.digests['sha256']
+        normal = TranscodeCache.key(source_hash, AudioFile.NORMAL, get_encoder_settings(AudioFile.NORMAL, 'mp3'))
+        for root, _, names in os.walk(cache.path):
+            for name in names:
+                if name != normal:
+                    os.remove(os.path.join(root, name))
+
+        Repository.create(self.path, self.store.id)
+        self.conversions, self.fail_at = [], 1  # The other tiers of the first song
+        with self.assertRaises(Interrupt):
+            self.commit(cache=cache)
+        staged = os.path.join(self.path, repository.STAGING_PATH, 'music', str(self.ids[0]), 'files')
+        self.assertTrue(os.path.exists(os.path.join(staged, 'normal.mp3')))
+        self.assertFalse(os.path.exists(os.path.join(staged, 'normal.mp3.md5')))
+        self.fail_at = None
+        self.commit(cache=cache)
+        self.assertComplete()
+
+    def test_interrupted_swap_is_finished_on_open(self):
+        Repository.create(self.path, self.store.id)
+        finish_commit = repository._finish_commit
+        rename = os.rename
+        renames = []
+
+        def interrupted_rename(src, dst):
+            renames.append(src)
+            if len(renames) == 2:
+                raise Interrupt
+            rename(src, dst)
+
+        def interrupted_finish_commit(path):
+            os.rename = interrupted_rename
+            try:
+                finish_commit(path)
+            finally:
+                os.rename = rename
+
+        repository._finish_commit = interrupted_finish_commit
+        try:
+            with self.assertRaises(Interrupt):
+                self.commit()
+        finally:
+            repository._finish_commit = finish_commit
+        self.assertTrue(os.path.exists(os.path.join(self.path, repository.STAGING_PATH)))
+        self.assertComplete()
+
+    def test_repository_before_sharded_catalog(self):
+        Repository.create(self.path, self.store.id)
+        shutil.rmtree(os.path.join(self.path, repository.CATALOG_PATH))
+        generate_repository_from_store(self.path, self.store, cache=TranscodeCache(os.path.join(self.work, 'cache')))
+        self.assertTrue(os.path.exists(os.path.join(self.path, repository.CATALOG_PATH, 'index')))
+        self.assertComplete()
+
+
+if __name__ == '__main__':
+    unittest.main()